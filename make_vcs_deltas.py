@@ -0,0 +1,129 @@
+"""
+litestream
+Copyright (C) 2026  spertilo.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Make the versioned vcs files that let the time machine update its collections with only the shows that changed.
+# --vcs_dir is a local copy of the vcs folder of the bucket. For each new <coll>_vcs.json we are given, we compare it
+# with the one in --vcs_dir, and if anything changed we bump the version and write
+#   <coll>_vcs.json                   the full vcs, as before
+#   <coll>/version.json               {"version": N}
+#   <coll>/changes/<v>.json           what changed between version v-1 and v
+#   <coll>/since/<v>.json             {"version": N, "vcs": {date: vcs}, "removed": [date]}, for the last --keep versions
+# A device with a version older than that gets a 404 for its since file, and downloads the full vcs. See
+# livemusic.aload_vcs and docs/update_metadata.md
+
+import argparse
+import json
+import logging
+import os
+
+parser = argparse.ArgumentParser(description="Make vcs delta files for the cloud")
+parser.add_argument("new_vcs", nargs="*", help="new <collection>_vcs.json files")
+parser.add_argument("--vcs_dir", default="vcs", help="local copy of the vcs folder of the bucket")
+parser.add_argument("--keep", type=int, default=30, help="number of old versions to keep since files for")
+parser.add_argument("--debug", type=int, default=0, help="If > 0, don't run the main script on loading")
+parms, remainder = parser.parse_known_args()
+
+logging.basicConfig(
+    format="%(asctime)s.%(msecs)03d %(levelname)s: %(name)s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+logger = logging.getLogger(__name__)
+
+
+def read_json(path, default=None):
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_json(obj, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(obj, f, separators=(",", ":"))
+
+
+def diff_vcs(old, new):
+    changed = {date: vcs for date, vcs in new.items() if old.get(date) != vcs}
+    removed = sorted(date for date in old if date not in new)
+    return changed, removed
+
+
+def merge_changes(changes):
+    # The changes from several versions, oldest first, as one
+    vcs = {}
+    removed = set()
+    for change in changes:
+        for date in change["removed"]:
+            vcs.pop(date, None)
+            removed.add(date)
+        for date, value in change["vcs"].items():
+            vcs[date] = value
+            removed.discard(date)
+    return vcs, sorted(removed)
+
+
+def write_since_files(coll_dir, version, keep):
+    oldest = max(1, version - keep)
+    for name in os.listdir(os.path.join(coll_dir, "changes")):
+        if int(name.split(".")[0]) <= oldest:
+            os.remove(os.path.join(coll_dir, "changes", name))
+    os.makedirs(os.path.join(coll_dir, "since"), exist_ok=True)
+    for name in os.listdir(os.path.join(coll_dir, "since")):
+        if int(name.split(".")[0]) < oldest:
+            os.remove(os.path.join(coll_dir, "since", name))
+
+    for since in range(oldest, version + 1):
+        changes = [read_json(os.path.join(coll_dir, "changes", f"{v}.json")) for v in range(since + 1, version + 1)]
+        vcs, removed = merge_changes(changes)
+        write_json({"version": version, "vcs": vcs, "removed": removed}, os.path.join(coll_dir, "since", f"{since}.json"))
+
+
+def update_collection(new_path, vcs_dir, keep):
+    coll = os.path.basename(new_path).replace("_vcs.json", "")
+    coll_dir = os.path.join(vcs_dir, coll)
+    full_path = os.path.join(vcs_dir, f"{coll}_vcs.json")
+    new = read_json(new_path)
+    old = read_json(full_path, {})
+    version = read_json(os.path.join(coll_dir, "version.json"), {"version": 0})["version"]
+
+    changed, removed = diff_vcs(old, new)
+    if version > 0 and not (changed or removed):
+        logger.info(f"{coll} unchanged at version {version}")
+        return version
+
+    version += 1
+    os.makedirs(os.path.join(coll_dir, "changes"), exist_ok=True)
+    if version > 1:
+        write_json({"vcs": changed, "removed": removed}, os.path.join(coll_dir, "changes", f"{version}.json"))
+    if os.path.abspath(new_path) != os.path.abspath(full_path):
+        write_json(new, full_path)
+    write_since_files(coll_dir, version, keep)
+    write_json({"version": version}, os.path.join(coll_dir, "version.json"))
+    logger.info(f"{coll} version {version}: {len(changed)} changed, {len(removed)} removed")
+    return version
+
+
+def main(parms):
+    for new_path in parms.new_vcs:
+        update_collection(new_path, parms.vcs_dir, parms.keep)
+
+
+if __name__ == "__main__" and parms.debug == 0:
+    main(parms)
@@ -0,0 +1,290 @@
+"""
+litestream
+Copyright (C) 2026  spertilo.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# A local stand-in for archive.org, the cloud bucket and the API, so that metadata and streaming can be benchmarked
+# without the network. Run it on a Linux box, and point the constants in the firmware at it, e.g.
+#   archive_utils.ARCHIVE_URL = "http://192.168.1.10:8080/archive.org"
+#   livemusic.CLOUD_PATH = "http://192.168.1.10:8080/storage.googleapis.com/spertilo-data"
+#   livemusic.API = "http://192.168.1.10:8080/gratefuldeadtimemachine.com"
+# A request for /<host>/<path> is answered from the fixture recorded for https://<host>/<path>.
+# With --record, missing fixtures are fetched from the real server and saved. See docs/replay_server.md
+
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+parser = argparse.ArgumentParser(description="Record and replay the HTTP endpoints used by the time machine")
+parser.add_argument("--fixtures", default="fixtures", help="directory of recorded responses")
+parser.add_argument("--bind", default="0.0.0.0", help="address to listen on")
+parser.add_argument("--port", type=int, default=8080, help="port to listen on")
+parser.add_argument("--public_url", default=None, help="url the device uses to reach us. Default http://<this host>:<port>")
+parser.add_argument(
+    "--static", action="append", default=[], help="PREFIX=DIR to serve /PREFIX/<path> from DIR/<path>, instead of fixtures"
+)
+parser.add_argument("--record", action="store_true", help="fetch and save responses we don't have yet")
+parser.add_argument("--rewrite", action="store_true", help="point absolute urls in redirects and text bodies back at us")
+parser.add_argument("--latency", type=int, default=0, help="ms before the response headers")
+parser.add_argument("--jitter", type=int, default=0, help="random extra ms of latency, up to this")
+parser.add_argument("--bandwidth", type=float, default=0, help="kbytes/s per connection. 0 for unlimited")
+parser.add_argument("--chunked", action="store_true", help="use chunked transfer encoding")
+parser.add_argument("--chunk_size", type=int, default=4096, help="bytes per chunk with --chunked")
+parser.add_argument("--gzip", action="store_true", help="gzip text bodies if the client accepts it")
+parser.add_argument("--fail_rate", type=float, default=0, help="fraction of requests answered with --fail_status")
+parser.add_argument("--fail_status", type=int, default=503, help="status for failed requests")
+parser.add_argument("--drop_rate", type=float, default=0, help="fraction of responses cut off half way through the body")
+parser.add_argument("--debug", type=int, default=0, help="If > 0, don't run the server on loading")
+parms, remainder = parser.parse_known_args()
+
+logging.basicConfig(
+    format="%(asctime)s.%(msecs)03d %(levelname)s: %(name)s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+logger = logging.getLogger(__name__)
+
+SAVED_HEADERS = ["content-type", "location", "etag", "last-modified"]
+TEXT_TYPES = ["json", "text", "mpegurl", "xml"]
+record_lock = threading.Lock()
+
+
+class Fixture:
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers  # lower case name -> value
+        self.body = body
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    # Record redirects as they are. The client follows them, back through us
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+def fixture_paths(host, path):
+    key = hashlib.sha1(f"{host}{path}".encode()).hexdigest()[:16]
+    base = os.path.join(parms.fixtures, host, key)
+    return f"{base}.json", f"{base}.body"
+
+
+def load_fixture(host, path):
+    meta_path, body_path = fixture_paths(host, path)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    with open(body_path, "rb") as f:
+        body = f.read()
+    return Fixture(meta["status"], meta["headers"], body)
+
+
+def static_fixture(request_path):
+    # A file from a --static directory, e.g. vcs deltas made by make_vcs_deltas.py. A missing file is a 404
+    for mapping in parms.static:
+        prefix, directory = mapping.split("=", 1)
+        prefix = "/" + prefix.strip("/") + "/"
+        if not request_path.startswith(prefix):
+            continue
+        file_path = os.path.join(directory, request_path[len(prefix) :].split("?")[0])
+        if not os.path.isfile(file_path):
+            return Fixture(404, {"content-type": "text/plain"}, b"No such file\n")
+        with open(file_path, "rb") as f:
+            body = f.read()
+        content_type = "application/json" if file_path.endswith(".json") else "application/octet-stream"
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()[:16]
+        return Fixture(200, {"content-type": content_type, "etag": etag}, body)
+    return None
+
+
+def record_fixture(host, path):
+    url = f"https://{host}{path}"
+    logger.info(f"recording {url}")
+    opener = urllib.request.build_opener(NoRedirect)
+    request = urllib.request.Request(url, headers={"User-Agent": "litestream-replay"})
+    try:
+        resp = opener.open(request, timeout=60)
+        status, headers, body = resp.status, resp.headers, resp.read()
+    except urllib.error.HTTPError as e:
+        status, headers, body = e.code, e.headers, e.read()
+
+    headers = {k.lower(): v for k, v in headers.items() if k.lower() in SAVED_HEADERS}
+    meta_path, body_path = fixture_paths(host, path)
+    with record_lock:
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        with open(body_path, "wb") as f:
+            f.write(body)
+        with open(meta_path, "w") as f:
+            json.dump({"url": url, "status": status, "headers": headers}, f, indent=1)
+    return Fixture(status, headers, body)
+
+
+def header_name(name):
+    # The device checks some headers case sensitively, e.g. Content-Range: and Location:
+    return "-".join(word.capitalize() for word in name.split("-"))
+
+
+def rewrite_urls(text, public_url):
+    # https://host/... -> <public_url>/host/...
+    return re.sub(r"https?://([A-Za-z0-9.-]+\.[A-Za-z]{2,})", lambda m: f"{public_url}/{m.group(1)}", text)
+
+
+def parse_range(range_header, size):
+    # "bytes=a-b", "bytes=a-" or "bytes=-n". Returns (start, end) inclusive, or None
+    m = re.match(r"bytes=(\d*)-(\d*)", range_header or "")
+    if not m or size == 0:
+        return None
+    first, last = m.groups()
+    if first == "":
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start, end = int(first), min(int(last) if last else size - 1, size - 1)
+    if start > end:
+        return None
+    return start, end
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def respond(self, send_body):
+        parts = self.path.lstrip("/").split("/", 1)
+        host, path = parts[0], "/" + (parts[1] if len(parts) > 1 else "")
+        if "." not in host:
+            return self.send_simple(404, b"Request /<host>/<path>\n")
+
+        delay = parms.latency + random.randint(0, parms.jitter) if parms.jitter else parms.latency
+        time.sleep(delay / 1000)
+        if random.random() < parms.fail_rate:
+            logger.info(f"failing {self.path}")
+            return self.send_simple(parms.fail_status, b"Injected failure\n")
+
+        fixture = static_fixture(self.path)
+        if fixture is None:
+            fixture = load_fixture(host, path)
+        if fixture is None and parms.record:
+            fixture = record_fixture(host, path)
+        if fixture is None:
+            logger.warning(f"no fixture for https://{host}{path}")
+            return self.send_simple(404, b"No fixture\n")
+
+        status, headers, body = fixture.status, dict(fixture.headers), fixture.body
+        content_type = headers.get("content-type", "")
+        is_text = any(t in content_type for t in TEXT_TYPES)
+        if parms.rewrite:
+            if "location" in headers:
+                headers["location"] = rewrite_urls(headers["location"], self.public_url())
+            if is_text:
+                body = rewrite_urls(body.decode("utf-8", "replace"), self.public_url()).encode()
+
+        etag = headers.get("etag")
+        if etag and self.headers.get("If-None-Match") == etag:
+            return self.send_simple(304, b"", {"etag": etag})
+
+        response_headers = {k: v for k, v in headers.items()}
+        byte_range = parse_range(self.headers.get("Range"), len(body)) if status == 200 else None
+        if byte_range is not None:
+            start, end = byte_range
+            response_headers["content-range"] = f"bytes {start}-{end}/{len(body)}"
+            body = body[start : end + 1]
+            status = 206
+        elif status == 200 and is_text and parms.gzip and "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            response_headers["content-encoding"] = "gzip"
+
+        self.send_response(status)
+        for k, v in response_headers.items():
+            self.send_header(header_name(k), v)
+        if parms.chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.send_header("Content-Length", str(len(body)))
+        self.send_header("Connection", "close")
+        self.end_headers()
+        if send_body:
+            self.send_body(body)
+        self.close_connection = True
+
+    def send_simple(self, status, body, headers={}):
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(header_name(k), v)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+        self.close_connection = True
+
+    def send_body(self, body):
+        drop_at = len(body) // 2 if random.random() < parms.drop_rate else None
+        step = parms.chunk_size if parms.chunked else 4096
+        start_time = time.time()
+        sent = 0
+        while sent < len(body):
+            piece = body[sent : sent + step]
+            if drop_at is not None and sent + len(piece) > drop_at:
+                logger.info(f"dropping {self.path} after {sent} bytes")
+                return
+            if parms.chunked:
+                piece = b"%x\r\n%s\r\n" % (len(piece), piece)
+            self.wfile.write(piece)
+            sent += step
+            if parms.bandwidth > 0:
+                ahead = min(sent, len(body)) / (parms.bandwidth * 1024) - (time.time() - start_time)
+                if ahead > 0:
+                    time.sleep(ahead)
+        if parms.chunked:
+            self.wfile.write(b"0\r\n\r\n")
+
+    def public_url(self):
+        if parms.public_url:
+            return parms.public_url.rstrip("/")
+        return f"http://{self.headers.get('Host', f'localhost:{parms.port}')}"
+
+    def log_message(self, format, *args):
+        logger.info(f"{self.address_string()} {format % args}")
+
+
+def main(parms):
+    os.makedirs(parms.fixtures, exist_ok=True)
+    server = ThreadingHTTPServer((parms.bind, parms.port), ReplayHandler)
+    logger.info(f"Serving {parms.fixtures} on {parms.bind}:{parms.port}{' (recording)' if parms.record else ''}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__" and parms.debug == 0:
+    main(parms)
@@ -22,18 +22,25 @@ import math
 import random
 import time
 import utils
+import http_cache
+import json_stream
+import metadata_store
 from mrequests import mrequests as requests
 
 CLOUD_API = "https://gratefuldeadtimemachine.com"  # google cloud version mapped to here
 CLOUD_PATH = "https://storage.googleapis.com/spertilo-data"
+ARCHIVE_URL = "https://archive.org"  # Point at replay_server.py to test without the network
 MAX_COLLECTIONS = 35
 STOP_CHAR = "$StoP$"
+HISTOGRAM_DIR = "/metadata/archive_histograms"
+HISTOGRAM_MAX_AGE = 30 * 24 * 3600  # seconds. Refresh the identifier counts monthly
+HISTOGRAM_FILES = 20
 
 
 def count_collection(collection, date_range, other_conds=[]):
     print(f"in count_collection {collection}, {date_range}")
     date_range_string = f"[{date_range[0]} TO {date_range[1]}]"
-    base_url = "https://archive.org/services/search/v1/scrape"
+    base_url = f"{ARCHIVE_URL}/services/search/v1/scrape"
     query = get_collection_query(collection, date_range_string, other_conds)
     url = f"{base_url}?debug=false&xvar=production&total_only=true&q={query}"
     print(url)
@@ -64,34 +71,46 @@ def get_collection_query(collection, year, other_conds=[]):
 
 
 def _get_data_from_archive(fields, query, count=None):
+    # Returns {field: [value for each item]}. Values are appended to the columns as each page is read, so a page is
+    # never held in memory as a list of item dicts. Items missing a field get None, to keep the columns aligned.
     if isinstance(fields, str):
         fields = [fields]
     field_str = "%2C".join(fields)
     n_items = 0
     total = 1
     cursor = ""
-    result = {}
+    result = {field: [] for field in fields}
+    page = {}
     batch_size = 10000 if count is None else min(count, 10000)
-    base_url = "https://archive.org/services/search/v1/scrape"
-    if isinstance(fields, str):
-        fields = [fields]
-    field_str = "%2C".join(fields)
+    base_url = f"{ARCHIVE_URL}/services/search/v1/scrape"
+
+    def on_value(path, value):
+        if path[0] == "items":
+            column = result[path[2]]
+            row = n_items + path[1]
+            while len(column) < row:
+                column.append(None)
+            column.append(value)
+        else:
+            page[path[0]] = value
+
+    paths = ["count", "total", "cursor"] + [f"items[*].{field}" for field in fields]
     while n_items < total:
+        # The cursor comes at the end of the page, so we can't ask for the next page until this one is read
         if len(cursor) > 0:
             url = f"{base_url}?debug=false&xvar=production&total_only=false&count={batch_size}&cursor={cursor}&fields={field_str}&q={query}"
         else:
             url = f"{base_url}?debug=false&xvar=production&total_only=false&count={batch_size}&fields={field_str}&q={query}"
         print(url)
-        j = _get_collection_year_chunk(url)
-        n_items += int(j["count"])
-        total = j["total"] if (count is None) else min(j["total"], count)
-        cursor = j.get("cursor", "")
+        page.clear()
+        _get_collection_year_chunk(url, paths, on_value)
+        n_items += int(page["count"])
+        for column in result.values():
+            while len(column) < n_items:
+                column.append(None)
+        total = page["total"] if (count is None) else min(page["total"], count)
+        cursor = page.get("cursor", "")
         print(f"{n_items}/{total} items downloaded")
-        for item in j["items"]:
-            for field in fields:
-                if not field in result.keys():
-                    result[field] = []
-                result[field].append(item.get(field, None))
     return result
 
 
@@ -103,7 +122,9 @@ class ArchiveDownError(Exception):
         return self.message
 
 
-def _get_collection_year_chunk(url):
+def _get_collection_year_chunk(url, paths=None, on_value=None):
+    # paths are the json_stream paths to keep from the response. Other fields are skipped as they are read.
+    # With on_value, the values are passed to it as they are read rather than returned
     resp = None
     try:
         resp = requests.get(url)
@@ -112,13 +133,11 @@ def _get_collection_year_chunk(url):
         if resp.status_code != 200:
             print(f"Error in request from {url}. Status code {resp.status_code}")
             raise Exception("Unsuccessful download")
-        if not resp.chunked:
+        if not resp.chunked and paths is None:
             j = resp.json()
         else:
-            resp.save("/tmp.json")
-            j = json.load(open("/tmp.json", "r"))
+            j = json_stream.load(resp, paths, on_value)
     finally:
-        utils.remove_file("/tmp.json")
         if resp is not None:
             resp.close()
     return j
@@ -133,67 +152,121 @@ def get_alphabet_bounds(center, radius):
         end_pos = 0.999999
         start_pos = 0.999999 - 2 * radius
 
-    def letters(f, n):
-        return chr(97 + int(f * math.pow(26, n + 1) % 26))
+    return alphabet_chars(start_pos), alphabet_chars(end_pos)
 
-    start_chars = "".join([letters(start_pos, i) for i in range(5)])
-    end_chars = "".join([letters(end_pos, i) for i in range(5)])
-    return start_chars, end_chars
+
+def alphabet_chars(pos, n=5):
+    # A position between 0 and 1 through the alphabet, as n letters
+    return "".join([chr(97 + int(pos * math.pow(26, i + 1) % 26)) for i in range(n)])
 
 
 def subset_collection(fields, collection, date_range, N_to_select, prefix=""):
     print("in subset_collection")
     date_range_string = f"[{date_range[0]} TO {date_range[1]}]"
-    collection_size = count_collection(collection, date_range)
-    print(f"in subset_collection -- size {collection_size}")
     max_size_to_pull = 10_000
     n_subsets = 5
+    histogram = get_prefix_histogram(collection, date_range, prefix)
+    collection_size = histogram["total"]
+    print(f"in subset_collection -- size {collection_size}")
     result_dict = {}
     if collection_size <= max_size_to_pull:
         query = get_collection_query(collection, date_range_string)
         data = _get_data_from_archive(fields, query)
         result_dict = data
     else:  # choose n_subsets, alphabetically, and combine them together.
+        # Each subset comes from a random first letter (after prefix) in its own stretch of the alphabet, so that they don't overlap.
+        # Only the letters we land on are counted, and the counts are kept in the histogram for next time.
         max_size_to_pull = 200 + max_size_to_pull // n_subsets
-        min_size_to_pull = min(N_to_select * 5, max_size_to_pull - 100)
+        span_size = min(max_size_to_pull - 200, N_to_select * 5)
         for i in range(n_subsets):
-            print(f"Looping, i is {i}")
-            radius = 0.5 * max_size_to_pull / (collection_size + 1)
-            center = random.random()
-            start_chars, end_chars = get_alphabet_bounds(center, radius)
-            start = f"{prefix}{start_chars if start_chars >= 'aa' else ''}"
-            end = f"{prefix}{end_chars}"
-            cond = f"identifier:[{start} TO {end}]"
-            size = count_collection(collection, date_range, [cond])
-            print(f"cond: {cond}. Size is {size}")
-            i_tries = 0
-            while ((size > max_size_to_pull) or (size < min_size_to_pull)) & (i_tries < 5):
-                # radius = radius * max(min((max_size_to_pull / (2 * size + 1)), 2), math.pow(0.9, i_tries + 1))
-                radius = radius * max(min((max_size_to_pull / (2 * size + 1)), 2), 0.8)
-                start_chars, end_chars = get_alphabet_bounds(center, radius)
+            first, last = 26 * i // n_subsets, 26 * (i + 1) // n_subsets
+            letter, size = choose_letter(histogram, collection, date_range, prefix, first, last, N_to_select)
+            if size > span_size:
+                # Take a random stretch of the letter, assuming its identifiers are spread evenly through it
+                fraction = span_size / size
+                start_pos = (letter + random.random() * (1 - fraction)) / 26
+                start_chars = alphabet_chars(start_pos)
+                end_chars = alphabet_chars(min(start_pos + fraction / 26, 0.999999))
                 start = f"{prefix}{start_chars if start_chars >= 'aa' else ''}"
                 end = f"{prefix}{end_chars}"
                 cond = f"identifier:[{start} TO {end}]"
-                size = count_collection(collection, date_range, [cond])
-                print(f"try {i_tries}. cond: {cond}. Size is {size}.")
-                i_tries = i_tries + 1
+                size = span_size
+            else:
+                cond = f"identifier:{prefix}{chr(97 + letter)}*"
+            print(f"cond: {cond}. Size is about {size}")
             if size < N_to_select:
                 print(f"WARNING only {size} ids match, skipping!")
                 continue
             query = get_collection_query(collection, date_range_string, [cond])
             print(f"query: {query}")
-            data = _get_data_from_archive(fields, query, count=min(size, max_size_to_pull))
+            data = _get_data_from_archive(fields, query, count=max_size_to_pull)
             for key in data.keys():
                 result_dict[key] = result_dict.get(key, []) + data[key]
 
+    if fields[0] not in result_dict:
+        print(f"WARNING no subset of {collection} had {N_to_select} ids")
+        return {field: [] for field in fields}
     indices = utils.deal_n(list(range(len(result_dict[fields[0]]))), N_to_select)
     for key in result_dict.keys():
         result_dict[key] = [result_dict[key][i] for i in indices]
     return result_dict
 
 
-def get_tape_metadata(identifier):
-    url_metadata = f"https://archive.org/metadata/{identifier}"
+def get_prefix_histogram(collection, date_range, prefix=""):
+    # The size of the collection, and the number of identifiers for each first letter after prefix, cached on flash.
+    # The letters are counted as they are needed, see count_letter. None means not counted yet.
+    path = f"{HISTOGRAM_DIR}/{collection}{prefix}_{date_range[0]}_{date_range[1]}.json"
+    if utils.path_exists(path):
+        try:
+            histogram = utils.read_json(path)
+            if (time.time() - histogram["time"] < HISTOGRAM_MAX_AGE) and (len(histogram["counts"]) == 26):
+                histogram["path"] = path
+                return histogram
+        except Exception as e:
+            print(f"Failed to read {path}: {e}")
+
+    histogram = {"time": time.time(), "total": count_collection(collection, date_range), "counts": [None] * 26, "path": path}
+    save_histogram(histogram)
+    return histogram
+
+
+def choose_letter(histogram, collection, date_range, prefix, first, last, N_to_select):
+    # A random letter from first to last - 1 with at least N_to_select identifiers, and its count. Thin letters (q, x, z, ...)
+    # are passed over for the next one along. If none is big enough, returns the biggest
+    start = random.randrange(first, last)
+    best = (start, -1)
+    for j in range(last - first):
+        letter = first + (start - first + j) % (last - first)
+        size = count_letter(histogram, collection, date_range, prefix, letter)
+        if size >= N_to_select:
+            return letter, size
+        if size > best[1]:
+            best = (letter, size)
+    return best
+
+
+def count_letter(histogram, collection, date_range, prefix, letter):
+    # The number of identifiers starting with prefix + letter (0 to 25), counted the first time we are asked
+    if histogram["counts"][letter] is None:
+        cond = f"identifier:{prefix}{chr(97 + letter)}*"
+        histogram["counts"][letter] = count_collection(collection, date_range, [cond])
+        save_histogram(histogram)
+    return histogram["counts"][letter]
+
+
+def save_histogram(histogram):
+    path = histogram.pop("path")
+    try:
+        utils.write_json(histogram, path)
+        utils.keep_only_n_files(HISTOGRAM_DIR, HISTOGRAM_FILES)
+    except Exception as e:
+        print(f"Failed to write {path}: {e}")
+    histogram["path"] = path
+
+
+def get_tape_metadata(identifier, paths=None):
+    # paths are the json_stream paths to keep, e.g. ["files[*].name", "files[*].format"]. The metadata of big items can be several MB
+    url_metadata = f"{ARCHIVE_URL}/metadata/{identifier}"
     print(url_metadata)
     resp = None
     try:
@@ -201,44 +274,40 @@ def get_tape_metadata(identifier):
         if resp.status_code != 200:
             print(f"Error in request from {url_metadata}. Status code {resp.status_code}")
             raise Exception("Download Error")
-        if not resp.chunked:
+        if not resp.chunked and paths is None:
             j = resp.json()
         else:
-            resp.save("/tmp.json")
-            j = json.load(open("/tmp.json", "r"))
+            j = json_stream.load(resp, paths)
     finally:
-        utils.remove_file("/tmp.json")
         if resp is not None:
             resp.close()
 
     return j
 
 
-def get_request(url, outpath="/tmp.json"):
+def get_request(url, outpath="/tmp.json", with_size=False):
+    # With with_size, returns (metadata, size), where size is the length of the json text, or 0 if the server didn't say
     resp = requests.get(url)
     if resp.status_code != 200:
         print(f"Failed to load from {url}")
-        return {}
-    if resp.chunked or outpath != "/tmp.json":
+        return ({}, 0) if with_size else {}
+    size = 0 if (resp.chunked or resp.compressed) else resp._content_size
+    if outpath != "/tmp.json":
+        # The caller wants a copy on flash
         print(f"saving json to {outpath}")
-        parent_dir = "/".join(outpath.split("/")[:-1])
-        utils.mkdirs(parent_dir)
-        resp.save(outpath)
-        resp.close()
+        metadata_store.save_response(resp, outpath)
         gc.collect()
-        metadata = json.load(open(outpath, "r"))
-    elif len(resp.text) > 1_000_000:
-        print("saving json to /tmp.json")
-        with open("/tmp.json", "w") as f:
-            f.write(resp.text)
-        resp.close()
-        gc.collect()
-        metadata = utils.read_json("/tmp.json")
-        utils.remove_file("/tmp.json")
+        metadata = metadata_store.read(outpath)
+    elif resp.chunked or resp._content_size > 100_000:
+        # Parse large responses as they arrive, rather than holding the text and the parsed object in memory at the same time
+        try:
+            metadata = json_stream.load(resp)
+        finally:
+            resp.close()
     else:
         metadata = resp.json()
 
-    return metadata
+    return (metadata, size) if with_size else metadata
 
 
 def collection_names():
@@ -256,7 +325,7 @@ def collection_names():
                 time.sleep(2)
             itries = itries + 1
             gc.collect()
-            resp = requests.get(cloud_url)
+            resp = http_cache.get(cloud_url)
             utils.print_log(f"Trying to download collections names from {cloud_url}")
             status = resp.status_code
             if status == 200:
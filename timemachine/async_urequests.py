@@ -6,6 +6,17 @@ import uasyncio as asyncio
 gc.collect()
 gc.threshold(gc.mem_free() // 4 + gc.mem_alloc())  # sets threshold to 1/4 of heap size
 
+try:
+    import io
+    import deflate
+except ImportError:
+    deflate = None
+
+try:
+    import ssl_context
+except ImportError:
+    ssl_context = None
+
 
 HTTP__version__ = "1.0"
 __version__ = (0, 0, 2)
@@ -21,9 +32,10 @@ class ConnectionError(Exception):
 
 class Response:
 
-    def __init__(self, reader, chunked, charset, h):
+    def __init__(self, reader, chunked, charset, h, content_encoding=None):
         self.raw = reader
         self.chunked = chunked
+        self.content_encoding = content_encoding
         self.encoder = charset
         self.h = h
         self.chunk_size = 0
@@ -48,7 +60,6 @@ class Response:
                 if self.chunk_size == 0:
                     sep = await self.raw.read(2)
                     assert sep == b"\r\n"
-                    break
         # non chunked data
         else:
             while True:
@@ -58,6 +69,13 @@ class Response:
                 content += data
         return content
 
+    def decode(self, content):
+        # Undo a gzip or deflate Content-Encoding. The whole body is already in memory, so decode it in one go
+        if deflate is None or self.content_encoding not in ("gzip", "deflate"):
+            return content
+        with deflate.DeflateIO(io.BytesIO(content), deflate.AUTO) as f:
+            return f.read()
+
     @property
     def text(self):
         return str(self.content, self.encoder)
@@ -103,22 +121,30 @@ async def open_connection(host, port, ssl):
     ai = socket.getaddrinfo(host, port)[0]
     s = socket.socket(ai[0], ai[1], ai[2])
     s.setblocking(False)
+    # Nothing else has the socket until we return the Stream, so close it if we fail or are cancelled (e.g. a hedged request that lost)
     try:
-        s.connect(ai[-1])
-    except OSError as er:
-        if er.args[0] != EINPROGRESS:
-            raise er
-    yield core._io_queue.queue_write(s)
-    if ssl:
-        import ssl
-
-        # STEVE added to avoid blocking
-        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-        s = ctx.wrap_socket(s, server_hostname=host, do_handshake_on_connect=False)
-        s.setblocking(False)
-        # end STEVE added. uncomment the following line to block
-        # s = ssl.wrap_socket(s, server_hostname=host)  # WARNING, this blocks for a long time
-    yield core._io_queue.queue_write(s)
+        try:
+            s.connect(ai[-1])
+        except OSError as er:
+            if er.args[0] != EINPROGRESS:
+                raise er
+        yield core._io_queue.queue_write(s)
+        if ssl:
+            # STEVE added to avoid blocking
+            if ssl_context is not None:
+                s = ssl_context.wrap_socket(s, host, do_handshake_on_connect=False)
+            else:
+                import ssl
+
+                ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+                s = ctx.wrap_socket(s, server_hostname=host, do_handshake_on_connect=False)
+            s.setblocking(False)
+            # end STEVE added. uncomment the following line to block
+            # s = ssl.wrap_socket(s, server_hostname=host)  # WARNING, this blocks for a long time
+        yield core._io_queue.queue_write(s)
+    except BaseException as e:
+        s.close()
+        raise e
     ss = Stream(s)
     return ss, ss
 
@@ -148,6 +174,15 @@ async def _request_raw(method, url, headers, data, json):
             raise ValueError("Unsupported protocol: %s" % (proto))
     # using new open_connection rather than uasyncio.open_connection to add ssl support
     reader, writer = await open_connection(host, port, ssl)
+    try:
+        return await _send_request(reader, writer, method, host, path, headers, data, json, ssl)
+    except BaseException as e:
+        # The caller never gets the reader, so it can't close it
+        await reader.wait_closed()
+        raise e
+
+
+async def _send_request(reader, writer, method, host, path, headers, data, json, ssl):
     query = "%s /%s HTTP/%s\r\nHost: %s\r\nConnection: close\r\n%s" % (method, path, HTTP__version__, host, headers)
     if "User-Agent:" not in query:
         query += "User-Agent: compat\r\n"
@@ -165,6 +200,8 @@ async def _request_raw(method, url, headers, data, json):
     if data:
         query += data
     await writer.awrite(query.encode())
+    if ssl and ssl_context is not None:
+        ssl_context.handshake_done(writer.s)
     return reader
 
 
@@ -189,6 +226,10 @@ async def _requests(
     try:
         # headers support
         h = ""
+        # Ask for a compressed body if we can decode it. Not for range requests, where the offsets refer to the encoded body.
+        names = [k.lower() for k in headers]
+        if deflate is not None and "accept-encoding" not in names and "range" not in names:
+            h += "Accept-Encoding: gzip, deflate\r\n"
         for k in headers:
             h += k
             h += ": "
@@ -218,6 +259,7 @@ async def _requests(
             if len(sline) > 1:
                 reason = sline[2].decode().rstrip()
             chunked = False
+            content_encoding = None
             json = None
             headers = []
             charset = "utf-8"
@@ -230,6 +272,8 @@ async def _requests(
                 if line.startswith(b"Transfer-Encoding:"):
                     if b"chunked" in line:
                         chunked = True
+                elif line.lower().startswith(b"content-encoding:"):
+                    content_encoding = line[17:].strip().lower().decode()
                 elif line.startswith(b"Location:"):
                     url = line.rstrip().split(None, 1)[1].decode()
                 elif line.startswith(b"Content-Type:"):
@@ -247,8 +291,8 @@ async def _requests(
                 continue
             break
 
-        resp = Response(reader, chunked, charset, headers)
-        resp.content = await resp.read()
+        resp = Response(reader, chunked, charset, headers, content_encoding)
+        resp.content = resp.decode(await resp.read())
         resp.status_code = status_code
         resp.reason = reason
         resp.url = url
@@ -20,7 +20,7 @@ import re, socket, time, gc
 from machine import Pin, I2S
 from errno import EINPROGRESS
 import select
-import ssl
+import ssl_context
 
 try:
     import AudioDecoder
@@ -41,6 +41,13 @@ decode_phase_inheader = const(1)
 decode_phase_readinfo = const(2)
 decode_phase_decoding = const(3)
 
+# Adaptive bitrate. quality 0 is the url as given, quality 1 is archive.org's 64kbps mp3 derivative of the same file
+quality_levels = const(2)
+throughput_window_ms = const(2000)
+
+# A second TLS socket for the head of the next track takes tens of kB of heap. Only open one if we have this much to spare
+head_min_mem_free = const(80_000)
+
 sck_pin = Pin(13)  # Serial clock output
 ws_pin = Pin(14)  # Word clock output
 sd_pin = Pin(17)  # Serial data output
@@ -295,6 +302,14 @@ class AudioPlayer:
         self.song_transition = None
         self.can_resume = True
 
+        # Network throughput (bytes per ms) and the bitrate of the stream being decoded. These decide which derivative of the next track we read
+        self.quality = self.track_quality = 0
+        self.throughput = 0
+        self.throughput_bytes = 0
+        self.throughput_start = None
+        self.bit_rate = 0
+        self.missing_derivatives = set()
+
         self.VorbisDecoder = AudioDecoder.VorbisDecoder()
         self.MP3Decoder = AudioDecoder.MP3Decoder()
 
@@ -323,6 +338,14 @@ class AudioPlayer:
         OutBufferSize = 700 * 1024
         self.OutBuffer = OutRingBuffer(OutBufferSize)
 
+        # The start of the next track, read while the buffers are full so that a skip to it can start decoding straight away.
+        # 64kB is a few seconds of audio at archive.org bitrates
+        self.HeadSize = 64 * 1024
+        self.NextHead = bytearray(self.HeadSize)
+        self.NextHeadMV = memoryview(self.NextHead)
+        self.head_sock = self.head_reader = None
+        self.clear_head()
+
         self.reset_player()
 
     def reset_player(self, reset_head=True):
@@ -337,13 +360,16 @@ class AudioPlayer:
         self.ID3Tag_size = 0
         self.PLAY_STATE = play_state_Stopped
 
+        # The byte offset to start the current track at when we next play(). Set by seek() when resuming a saved position
+        self.start_offset = 0
+
         if reset_head:
             if self.ntracks > 0:
                 self.current_track = 0
                 self.next_track = 1 if self.ntracks > 1 else None
                 self.callbacks["display"](*self.track_names())
 
-        # TrackInfo is a list of track lengths and their corresponding audio type (vorbis or MP3). This tells the decoder when to move onto the next track, and also which decoder to use.
+        # TrackInfo is a list of track lengths, their corresponding audio type (vorbis or MP3) and the quality of the file read. This tells the decoder when to move onto the next track, and also which decoder to use.
         self.TrackInfo = []
 
         # PlayInfo is filled out when the decoder starts a new track, and tells the play loop the format of the track (rate, bits, channels)
@@ -378,6 +404,9 @@ class AudioPlayer:
             self.sock.close()
             self.sock = None
 
+        # Abandon a half-read head of the next track, but keep a complete one so that a skip can use it
+        self.close_head()
+
         # Used for statistics during debugging
         self.consecutive_zeros = 0
 
@@ -409,10 +438,9 @@ class AudioPlayer:
 
         return retstring
 
-    def set_playlist(self, tracklist, urllist):
+    def clean_tracks(self, tracklist, urllist):
         assert len(tracklist) == len(urllist)
-        self.ntracks = len(tracklist)
-        self.tracklist = [re.sub(r"^\d*[\.\)\- ]*", "", x) for x in tracklist]
+        tracklist = [re.sub(r"^\d*[\.\)\- ]*", "", x) for x in tracklist]
         ### TEMPORARY ###
         setbreak_url = "https://storage.googleapis.com/spertilo-data/sundry/silence600.ogg"
         urllist = [x if not (x.endswith("silence600.ogg")) else setbreak_url for x in urllist]
@@ -420,13 +448,42 @@ class AudioPlayer:
         urllist = [x if not (x.endswith("silence0.ogg")) else encorebreak_url for x in urllist]
         ### END TEMPORARY ###
         urllist = [x.replace(" ", "%20") for x in urllist]
-        self.playlist = urllist
+        return tracklist, urllist
+
+    def set_playlist(self, tracklist, urllist):
+        self.tracklist, self.playlist = self.clean_tracks(tracklist, urllist)
+        self.ntracks = len(self.playlist)
+        self.missing_derivatives = set()
+        self.close_head()
+        self.clear_head()
 
         if self.ntracks > 0:
             self.current_track = 0
             self.next_track = self.set_next_track()
         self.callbacks["display"](*self.track_names())
 
+    def extend_playlist(self, tracklist, urllist):
+        # Add tracks to the end of the playlist without disturbing the track that is playing
+        tracklist, urllist = self.clean_tracks(tracklist, urllist)
+        if len(urllist) == 0:
+            return
+        old_ntracks = self.ntracks
+        self.tracklist = self.tracklist + tracklist
+        self.playlist = self.playlist + urllist
+        self.ntracks = len(self.playlist)
+
+        if self.current_track is None:
+            self.current_track = 0
+        self.next_track = self.set_next_track()
+
+        # If we had already read to the end of the old playlist, carry on reading into the new tracks.
+        # Once the decoder has finished too it's too late, and the playlist will end as before.
+        if self.PLAY_STATE != play_state_Stopped and not self.ReadLoopRunning and self.DecodeLoopRunning:
+            if self.track_being_read == old_ntracks - 1:
+                print("Track read start")
+                self.read_http_header(old_ntracks)
+        self.callbacks["display"](*self.track_names())
+
     def track_status(self):
         if self.current_track is None:
             return {}
@@ -466,7 +523,9 @@ class AudioPlayer:
 
         if self.PLAY_STATE == play_state_Stopped:
             print("Track read start")
-            self.read_http_header(self.current_track)
+            at_head = self.start_offset == 0 and self.current_track is not None and self.current_track == self.next_head_track
+            if not (at_head and self.play_from_head()):
+                self.read_http_header(self.current_track, self.start_offset)
             self.PLAY_STATE = play_state_Playing
 
         elif self.PLAY_STATE == play_state_Playing:
@@ -505,6 +564,28 @@ class AudioPlayer:
 
         return True
 
+    def seek(self, trackno, offset=0, quality=0):
+        # Set where the next play() starts from. Used to resume a saved position, so only when stopped
+        if not self.is_stopped() or not 0 <= trackno < self.ntracks:
+            return False
+
+        self.current_track = trackno
+        self.next_track = self.set_next_track()
+        self.start_offset = offset
+        self.track_quality = quality
+        self.callbacks["display"](*self.track_names())
+        return True
+
+    def position(self):
+        # The track we are decoding and how far through it we are. Playback lags this by the size of the OutBuffer, so resuming from here repeats a few seconds.
+        # We can only restart mp3s mid-track (the decoder finds the next sync word). Vorbis needs the stream headers, so ogg tracks restart at the beginning
+        if self.current_track is None or len(self.TrackInfo) == 0 or self.decode_phase != decode_phase_decoding:
+            return None
+
+        offset = self.current_track_bytes_decoded_in if self.TrackInfo[0][1] == format_MP3 else 0
+        # The offset only makes sense in the file we are decoding, which may be a derivative, so return the quality it was read at
+        return self.current_track, offset, self.TrackInfo[0][2]
+
     def set_next_track(self):
         if self.current_track is None:
             return None
@@ -545,9 +626,58 @@ class AudioPlayer:
         port = 80 if parts[0] == "http" else 443 if parts[0] == "https" else 0
         url = parts[1].split("/", 1)
         host = url[0]
+        if ":" in host:
+            host, port = host.split(":", 1)
+            port = int(port)
         path = url[1] if url[1].startswith("/") else "/" + url[1]
         return host, port, path
 
+    def derivative_url(self, url, quality):
+        # archive.org makes a 64kbps mp3 from each original file. Only use it for archive.org downloads, and not if we already know it isn't there
+        if quality == 0 or "archive.org/download/" not in url or url in self.missing_derivatives:
+            return url
+
+        base = url.rsplit(".", 1)[0]
+        if base.endswith("_64kb"):
+            return url
+        return base + "_64kb.mp3"
+
+    def update_throughput(self, nbytes):
+        # Only time the network while there is room in the InBuffer, otherwise we measure how fast we are playing, not how fast we can read
+        if nbytes is None:
+            self.throughput_start = None
+            self.throughput_bytes = 0
+            return
+
+        now = time.ticks_ms()
+        if self.throughput_start is None:
+            self.throughput_start = now
+            self.throughput_bytes = 0
+
+        self.throughput_bytes += nbytes
+        elapsed = time.ticks_diff(now, self.throughput_start)
+        if elapsed >= throughput_window_ms:
+            rate = self.throughput_bytes / elapsed
+            self.throughput = rate if self.throughput == 0 else 0.7 * self.throughput + 0.3 * rate
+            self.throughput_start = now
+            self.throughput_bytes = 0
+
+    def select_quality(self):
+        # Called when we start reading a new track. Drop to the low bitrate derivative if the network can't keep up with the stream we are
+        # decoding and the InBuffer is draining, and go back up when there is plenty of headroom (the 64kbps derivative is about a third of the bitrate)
+        if self.throughput == 0 or self.bit_rate == 0:
+            return self.quality
+
+        needed = self.bit_rate / 8000
+        if self.quality < quality_levels - 1 and self.throughput < 1.2 * needed and self.InBuffer.buffer_level() < 0.5:
+            self.quality += 1
+            print(f"Throughput {self.throughput:.0f} kB/s is too low for {needed:.0f} kB/s. Switching to quality {self.quality}")
+        elif self.quality > 0 and self.throughput > 4 * needed:
+            self.quality -= 1
+            print(f"Throughput {self.throughput:.0f} kB/s has recovered. Switching to quality {self.quality}")
+
+        return self.quality
+
     def read_http_header(self, trackno, offset=0, port=80):
         if trackno is None:
             return
@@ -556,7 +686,11 @@ class AudioPlayer:
         self.current_track_bytes_read = offset
         #        self.playlist_started = True
         self.track_being_read = trackno
-        url = self.playlist[trackno]
+
+        # Pick the derivative when we start a track. If we are resuming a track after a long pause (or from a saved position), keep reading the same file
+        if offset == 0:
+            self.track_quality = self.select_quality()
+        url = self.derivative_url(self.playlist[trackno], self.track_quality)
         host, port, path = self.parse_url(url.encode())
         assert port > 0, "Invalid URL prefix"
 
@@ -591,8 +725,7 @@ class AudioPlayer:
         # This provides a "virtual socket" on top of the real socket and handles all the encryption/decryption
         # For non-SSL, just use the socket as-is
         if port == 443:
-            ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-            self.sock = ctx.wrap_socket(conn, server_hostname=host, do_handshake_on_connect=False)
+            self.sock = ssl_context.wrap_socket(conn, host, do_handshake_on_connect=False)
             self.sock.setblocking(False)
         else:
             self.sock = conn
@@ -619,6 +752,7 @@ class AudioPlayer:
                 data = data[n:]
 
         poller.unregister(self.sock)
+        ssl_context.handshake_done(self.sock)
 
         # Read the response headers
         response_headers = b""
@@ -685,8 +819,7 @@ class AudioPlayer:
 
                 # If this is an SSL connection, wrap the socket in an SSLContext.
                 if port == 443:
-                    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-                    self.sock = ctx.wrap_socket(conn, server_hostname=host, do_handshake_on_connect=False)
+                    self.sock = ssl_context.wrap_socket(conn, host, do_handshake_on_connect=False)
                     self.sock.setblocking(False)
                 else:
                     self.sock = conn
@@ -711,6 +844,7 @@ class AudioPlayer:
                         data = data[n:]
 
                 poller.unregister(self.sock)
+                ssl_context.handshake_done(self.sock)
 
                 # Read the response headers
                 response_headers = b""
@@ -732,6 +866,13 @@ class AudioPlayer:
 
         # Make sure we know the length of the track and got a valid response from the server. If not, skip this track.
         if track_length == 0 or (b"HTTP/1.1 200" not in response_headers and b"HTTP/1.1 206" not in response_headers):
+            # If there is no low bitrate derivative of this track, go back to the original
+            if url != self.playlist[trackno]:
+                print("No derivative at", url)
+                self.missing_derivatives.add(self.playlist[trackno])
+                self.read_http_header(trackno, offset)
+                return
+
             print("Bad URL:", url)
             print("Headers:", response_headers)
             print("TrackLength:", track_length)
@@ -741,13 +882,14 @@ class AudioPlayer:
             self.handle_end_of_track_read()
             return
 
-        # Store the end-of-track and format marker for this track (except if we are restarting a track)
+        # Store the end-of-track and format marker for this track (except if we are restarting a track after a long pause, when it is already there)
+        new_track = offset == 0 or len(self.TrackInfo) == 0
         if path.lower().endswith(".mp3"):
-            if offset == 0:
-                self.TrackInfo.append((track_length, format_MP3))
+            if new_track:
+                self.TrackInfo.append((track_length, format_MP3, self.track_quality))
         elif path.lower().endswith(".ogg"):
-            if offset == 0:
-                self.TrackInfo.append((track_length, format_Vorbis))
+            if new_track:
+                self.TrackInfo.append((track_length, format_Vorbis, self.track_quality))
         else:
             raise RuntimeError("Unsupported audio type")
 
@@ -766,17 +908,179 @@ class AudioPlayer:
         else:
             # We have no more data to read from the network, but we have to let the decoder run out, and then let the play loop run out
             print("Finished reading playlist")
-            self.sock.close()
-            del self.sock
-            self.sock = None
+            if self.sock is not None:
+                self.sock.close()
+                del self.sock
+                self.sock = None
             self.ReadLoopRunning = False
             # self.playlist_started = False
 
+    def clear_head(self):
+        self.next_head_track = None
+        self.next_head_len = 0
+        self.next_head_length = 0
+        self.next_head_format = None
+        self.next_head_quality = 0
+        self.head_failed_track = None
+
+    def close_head(self):
+        if self.head_sock is not None:
+            self.head_sock.close()
+            self.head_sock = None
+        self.head_reader = None
+
+    def prefetch_next_head(self):
+        # Called from audio_pump when both buffers are full. Each call does one step of reading the head of the next track
+        if self.head_reader is None:
+            trackno = self.next_track
+            if trackno is None or trackno == self.next_head_track or trackno == self.head_failed_track:
+                return
+            if gc.mem_free() < head_min_mem_free:
+                gc.collect()
+                if gc.mem_free() < head_min_mem_free:
+                    return
+            self.head_reader_track = trackno
+            self.head_reader = self.read_head(trackno)
+
+        try:
+            next(self.head_reader)
+        except StopIteration:
+            self.close_head()
+        except Exception as e:
+            print(f"Failed to read the head of track {self.head_reader_track}: {e}")
+            self.head_failed_track = self.head_reader_track
+            self.close_head()
+
+    def read_head(self, trackno):
+        # A generator that reads the first HeadSize bytes of a track into NextHead, yielding whenever it would have to wait for the network
+        quality = self.quality
+        url = self.derivative_url(self.playlist[trackno], quality)
+
+        # Follow up to 3 redirects
+        for _ in range(4):
+            host, port, path = self.parse_url(url.encode())
+            assert port > 0, "Invalid URL prefix"
+            conn = socket.socket()
+            addr = socket.getaddrinfo(host, port)[0][-1]
+            conn.setblocking(False)
+            try:
+                conn.connect(addr)
+            except OSError as er:
+                if er.errno != EINPROGRESS:
+                    raise RuntimeError("Socket connect error")
+
+            if port == 443:
+                self.head_sock = ssl_context.wrap_socket(conn, host, do_handshake_on_connect=False)
+                self.head_sock.setblocking(False)
+            else:
+                self.head_sock = conn
+            yield
+
+            data = bytes(f"GET {path} HTTP/1.1\r\nHost: {host}\r\nRange: bytes=0-{self.HeadSize - 1}\r\n\r\n", "utf8")
+            while data:
+                n = self.head_sock.write(data)
+                if n is not None:
+                    data = data[n:]
+                yield
+
+            ssl_context.handshake_done(self.head_sock)
+
+            status = location = None
+            track_length = 0
+            while True:
+                header = self.head_sock.readline()
+                if header is None:
+                    yield
+                    continue
+                if header == b"":
+                    raise RuntimeError("Peer closed socket")
+                if status is None:
+                    status = header
+                if header.lower().startswith(b"location:"):
+                    location = header.split(b": ", 1)[1].strip()
+                elif header.lower().startswith(b"content-range:"):
+                    track_length = int(header.split(b"/", 1)[1])
+                if header == b"\r\n":
+                    break
+
+            if location and (b" 301" in status or b" 302" in status):
+                self.head_sock.close()
+                url = location.decode()
+                continue
+            break
+
+        # We need the server to honour the Range header, so that we can ask for the rest of the track later
+        if b" 206" not in status or track_length == 0:
+            raise RuntimeError(f"Bad response {status}")
+
+        if path.lower().endswith(".mp3"):
+            track_format = format_MP3
+        elif path.lower().endswith(".ogg"):
+            track_format = format_Vorbis
+        else:
+            raise RuntimeError("Unsupported audio type")
+
+        head_len = 0
+        wanted = min(self.HeadSize, track_length)
+        while head_len < wanted:
+            n = self.head_sock.readinto(self.NextHeadMV[head_len:], wanted - head_len)
+            if n == 0:
+                raise RuntimeError("Peer closed socket")
+            if n is not None:
+                head_len += n
+            yield
+
+        self.next_head_track = trackno
+        self.next_head_len = head_len
+        self.next_head_length = track_length
+        self.next_head_format = track_format
+        self.next_head_quality = quality
+        print(f"Read {head_len} bytes of the head of track {trackno}")
+
+    def play_from_head(self):
+        # We already have the start of this track, so put it in the InBuffer and start playing while we connect for the rest of it.
+        # Returns False if the head doesn't fit in the InBuffer, and the track should be read from the start instead
+        trackno = self.next_head_track
+        n = self.next_head_len
+        self.next_head_track = None
+        if self.InBuffer.BufferSize - self.InBuffer.get_bytes_in_buffer() < n:
+            print(f"No room for the head of track {trackno}")
+            return False
+        print(f"Playing track {trackno} from the {n} bytes we already have")
+
+        # The free space may wrap around the end of the ring, so write it in as many pieces as it takes
+        written = 0
+        while written < n:
+            BytesToWrite = min(self.InBuffer.get_write_available(), n - written)
+            assert BytesToWrite > 0, "InBuffer full writing the head"
+            writePos = self.InBuffer.get_writePos()
+            self.InBuffer.Buffer[writePos : writePos + BytesToWrite] = self.NextHeadMV[written : written + BytesToWrite]
+            self.InBuffer.bytes_wasWritten(BytesToWrite)
+            written += BytesToWrite
+        self.track_quality = self.next_head_quality
+        self.TrackInfo.append((self.next_head_length, self.next_head_format, self.track_quality))
+        self.DecodeLoopRunning = True
+
+        # Let the decoder and play loop run while we are connecting
+        self.PLAY_STATE = play_state_Playing
+        self.unmute_audio()
+
+        if n < self.next_head_length:
+            self.read_http_header(trackno, n)
+        else:
+            # The whole track fitted in the head, so move on to reading the next one
+            self.track_being_read = trackno
+            self.current_track_bytes_read = n
+            self.handle_end_of_track_read()
+        return True
+
     def read_chunk(self):
         # If there is any free space in the input buffer then add any data available from the network
         # If there is no socket then we have already read to the end of the playlist
         if self.sock is not None:
-            if (BytesAvailable := self.InBuffer.get_write_available()) > 0:
+            if (BytesAvailable := self.InBuffer.get_write_available()) == 0:
+                self.update_throughput(None)
+            else:
                 # We can get an exception here if we pause too long and the underlying socket gets closed
                 try:
                     # Read data into the InBuffer if there new data available. The readinto() will return None if there is no data available, or 0 if the socket is closed
@@ -787,6 +1091,7 @@ class AudioPlayer:
                         # We will need this if the user pauses for too long and we need to request the current track from the server again
                         self.current_track_bytes_read += data
                         self.InBuffer.bytes_wasWritten(data)
+                        self.update_throughput(data)
 
                         # Start the decode loop
                         self.DecodeLoopRunning = True
@@ -839,12 +1144,15 @@ class AudioPlayer:
             # Work out the size of the ID3 tag (if any) at the beginning
             if self.ID3Tag_size == 0:
                 print(f"Track {self.current_track} decode start")
-                self.current_track_bytes_decoded_in = 0
+                # If we are starting part way through a track, count the bytes we skipped. The decoder will re-sync on the next sync word
+                self.current_track_bytes_decoded_in = self.start_offset
                 self.current_track_bytes_decoded_out = 0
                 readpos = self.InBuffer.get_readPos()
 
                 # If there is an ID3 tag at the beginning then work out the size
-                if (
+                if self.start_offset > 0:
+                    self.start_offset = 0
+                elif (
                     self.InBuffer.Bytes[readpos] == ord(b"I")
                     and self.InBuffer.Bytes[readpos + 1] == ord(b"D")
                     and self.InBuffer.Bytes[readpos + 2] == ord(b"3")
@@ -1044,6 +1352,7 @@ class AudioPlayer:
                 self.DEBUG and print("Sample Rate:", sample_rate)
                 self.DEBUG and print("Bits per Sample:", bits_per_sample)
                 self.DEBUG and print("Bitrate:", bit_rate)
+                self.bit_rate = bit_rate
 
                 # Store the track info so that the play loop can init the I2S device at the beginning of the track
                 self.PlayInfo.append((channels, sample_rate, bits_per_sample))
@@ -1240,4 +1549,9 @@ class AudioPlayer:
             self.play_chunk()
 
         buffer_level_in = self.InBuffer.buffer_level()
+
+        # When both buffers are full there is time to read the start of the next track, so that skipping to it is quick
+        if buffer_level_out > 0.9 and (buffer_level_in > 0.9 or not self.ReadLoopRunning):
+            self.prefetch_next_head()
+
         return min(buffer_level_in, buffer_level_out)
@@ -22,13 +22,18 @@ import micropython
 import time
 from errno import EINPROGRESS
 import select
-import ssl
+import ssl_context
 
 try:
     import AudioDecoder
 except ImportError:
     import AACDecoder
 
+try:
+    import _thread
+except ImportError:
+    _thread = None
+
 if not "AAC_Decoder" in dir(AudioDecoder):
     raise ImportError("Firmware is out of date")
 
@@ -54,6 +59,12 @@ play_phase_playing = const(2)
 play_phase_paused = const(3)
 play_phase_end = const(4)
 
+# Pump scheduler. The pump runs sooner when the OutBuffer is low and backs off when there is nothing to do
+pump_period_min = const(5)
+pump_period_default = const(10)
+pump_period_max = const(40)
+read_bursts_max = const(4)
+
 audioplayer_state_Stopped = const(0)
 audioplayer_state_Playing = const(1)
 audioplayer_state_Paused = const(2)
@@ -317,11 +328,15 @@ class TrackReader:
         self.read_phase = read_phase_idle
         self.TrackLength = 0
         self.hash_being_read = None
+        self.url_being_read = None
 
         if self.sock is not None:
             self.sock.close()
             self.sock = None
 
+        # The number of socket reads to do per pump. This grows while the network is fast, and drops back to 1 when it isn't
+        self.read_bursts = 1
+
         # The number of bytes of the current track that we have read from the network
         # This is compared against the length of the track returned from the server in the Content-Range or content-length header to determine end-of-track read
         # This is potentially different to which track we are currently playing. We could be reading ahead of decoding and playing by one or more tracks
@@ -333,7 +348,7 @@ class TrackReader:
     def isRunning(self):
         return self.read_phase != read_phase_idle
 
-    def read_chunk(self):
+    def read_chunk(self, max_bursts=1):
         if self.read_phase == read_phase_idle:
             return
 
@@ -345,6 +360,14 @@ class TrackReader:
                 next(self.trackReader)
             except StopIteration:
                 pass
+            except Exception as e:
+                # We couldn't reconnect to carry on with a track. Fall back to letting the caller restart the playlist
+                if self.current_track_bytes_read > 0:
+                    print(f"Failed to restart track {self.hash_being_read}: {e}")
+                    self.read_phase = read_phase_idle
+                    self.callbacks["messages"](f"read_chunk: long pause {self.hash_being_read}")
+                else:
+                    raise
 
         # Have we read to the end of the track?
         elif self.read_phase == read_phase_end:
@@ -355,41 +378,65 @@ class TrackReader:
             if self.sock is None:
                 return 0
 
-            # If no free space in the input buffer return, otherwise add any data available from the network
-            if (InBufferBytesAvailable := self.context.InBufferSize - self.context.InBuffer.any()) == 0:
-                return 0
+            # Read up to read_bursts chunks in one go while the network keeps up with us. The pump scheduler caps this with max_bursts
+            for _ in range(min(self.read_bursts, max_bursts)):
+                data = self.read_socket()
 
+                if data is None or self.read_phase != read_phase_read:
+                    break
+
+            # Grow the burst size while each read fills the whole read buffer (the network is faster than we are pumping), shrink it when there was nothing waiting
+            if data == self.ReadBufferSize:
+                self.read_bursts = min(self.read_bursts + 1, read_bursts_max)
+            elif data is None and self.read_bursts > 1:
+                self.read_bursts -= 1
+
+    def read_socket(self):
+        # If no free space in the input buffer return, otherwise add any data available from the network
+        if (InBufferBytesAvailable := self.context.InBufferSize - self.context.InBuffer.any()) == 0:
+            return None
+
+        data = None
+
+        # We can get an exception here if we pause too long and the underlying socket gets closed
+        try:
+            # Read data into the InBuffer if there new data available. The readinto() will return None if there is no data available, or 0 if the socket is closed
+            # Only read a maximum of as many bytes as will fit into the InBuffer or the ReadBuffer
+            data = self.sock.readinto(self.ReadBufferMV, min(self.ReadBufferSize, InBufferBytesAvailable))
+
+            if data is not None:
+                # Keep track of how many bytes of the current file we have read.
+                # We will need this if the user pauses for too long and we need to request the current track from the server again
+                self.current_track_bytes_read += data
+                self.context.InBuffer.write(self.ReadBufferMV[0:data])
+
+            # Have we read to the end of the track?
+            if self.current_track_bytes_read == self.TrackLength:  # self.context.TrackInfo[-1][0]:
+                self.read_phase = read_phase_end
+
+            # Peer closed socket. This is usually because we are in a long pause, and our socket closes
+            if data == 0:
+                print("Peer close")
+                raise RuntimeError("Peer closed socket")
+
+        # The user probably paused too long and the underlying socket got closed
+        # In this case we re-start reading the current track at the offset that we got up to before the pause. Uses the HTTP Range header to request data at an offset
+        # Everything already in the InBuffer and OutBuffer is kept, so playback carries on while we reconnect
+        except Exception as e:
+            print("Socket Exception:", e, " Restarting track at offset", self.current_track_bytes_read)
+            self.restart_track()
             data = None
 
-            # We can get an exception here if we pause too long and the underlying socket gets closed
-            try:
-                # Read data into the InBuffer if there new data available. The readinto() will return None if there is no data available, or 0 if the socket is closed
-                # Only read a maximum of as many bytes as will fit into the InBuffer or the ReadBuffer
-                data = self.sock.readinto(self.ReadBufferMV, min(self.ReadBufferSize, InBufferBytesAvailable))
-
-                if data is not None:
-                    # Keep track of how many bytes of the current file we have read.
-                    # We will need this if the user pauses for too long and we need to request the current track from the server again
-                    self.current_track_bytes_read += data
-                    self.context.InBuffer.write(self.ReadBufferMV[0:data])
-
-                # Have we read to the end of the track?
-                if self.current_track_bytes_read == self.TrackLength:  # self.context.TrackInfo[-1][0]:
-                    self.read_phase = read_phase_end
-
-                # Peer closed socket. This is usually because we are in a long pause, and our socket closes
-                if data == 0:
-                    print("Peer close")
-                    raise RuntimeError("Peer closed socket")
-
-            # The user probably paused too long and the underlying socket got closed
-            # In this case we re-start playing the current track at the offset that we got up to before the pause. Uses the HTTP Range header to request data at an offset
-            except Exception as e:
-                print("Socket Exception:", e, " Restarting track at offset", self.current_track_bytes_read)
-                self.callbacks["messages"](f"read_chunk: long pause {self.hash_being_read}")
+        return data
+
+    def restart_track(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
 
-                # Start reading the current track again, but at the offset where we were up to
-                # self.start_track(self.current_track_bytes_read)
+        self.callbacks["messages"](f"read_chunk: Restarting track {self.hash_being_read}")
+        self.trackReader = self.start_track(self.current_track_bytes_read, (self.url_being_read, self.hash_being_read))
+        self.read_phase = read_phase_start
 
     def end_track(self):
         self.DEBUG and print(f"Track {self.hash_being_read} read end", end=" - ")
@@ -409,12 +456,14 @@ class TrackReader:
             self.sock = None
             self.read_phase = read_phase_idle
 
-    def start_track(self, offset=0):
+    def start_track(self, offset=0, track=None):
         track_length = 0
         self.current_track_bytes_read = offset
 
-        url, hash = self.context.playlist.pop(0)
+        # track is given when we are re-starting the track we were reading, otherwise take the next one from the playlist
+        url, hash = self.context.playlist.pop(0) if track is None else track
         self.hash_being_read = hash
+        self.url_being_read = url
         host, port, path = self.parse_url(url.encode())
 
         # We might have a socket already from the previous track
@@ -422,8 +471,9 @@ class TrackReader:
             self.sock.close()
             self.sock = None
 
-        self.DEBUG and print(f"Track {self.hash_being_read} read start")
-        self.callbacks["messages"](f"read_chunk: Start reading track {self.hash_being_read}")
+        if offset == 0:
+            self.DEBUG and print(f"Track {self.hash_being_read} read start")
+            self.callbacks["messages"](f"read_chunk: Start reading track {self.hash_being_read}")
 
         while True:
             # Load up the output buffer before the expensive SSL connect
@@ -452,8 +502,7 @@ class TrackReader:
             # This provides a "virtual socket" on top of the real socket and handles all the encryption/decryption
             # For non-SSL, just use the socket as-is
             if port == 443:
-                ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-                self.sock = ctx.wrap_socket(conn, server_hostname=host, do_handshake_on_connect=False)
+                self.sock = ssl_context.wrap_socket(conn, host, do_handshake_on_connect=False)
                 self.sock.setblocking(False)
             else:
                 self.sock = conn
@@ -477,9 +526,11 @@ class TrackReader:
                     data = data[n:]
 
             poller.unregister(self.sock)
+            ssl_context.handshake_done(self.sock)
 
             # Read the response headers
             response_headers = b""
+            content_range = False
             while True:
                 header = self.sock.readline()
                 yield
@@ -489,10 +540,12 @@ class TrackReader:
 
                     # Save the length of the track. We use this to keep track of when we have finished reading a track rather than relying on EOF
                     # EOF is indistinguishable from the host closing a socket when we pause too long
+                    # When we ask for an offset the Content-Length is only the rest of the track, so the Content-Range takes precedence
                     if header.lower().startswith(b"content-range:"):
                         track_length = int(header.split(b"/", 1)[1])
+                        content_range = True
 
-                    if header.lower().startswith(b"content-length:"):
+                    if header.lower().startswith(b"content-length:") and not content_range:
                         track_length = int(header.split(b":", 1)[1])
 
                 if header == b"\r\n":
@@ -523,10 +576,19 @@ class TrackReader:
             print("Bad URL:", url)
             print("Headers:", response_headers)
             print("TrackLength:", track_length)
+
+            # If we were part way through the track we can't skip it, since the decoder is expecting the rest of it
+            if offset > 0:
+                raise RuntimeError("Could not restart track")
+
             self.current_track_bytes_read = 0
             self.read_phase = read_phase_end
             return
 
+        # We asked for the rest of the track but got all of it, so the server doesn't support Range requests
+        if offset > 0 and b"HTTP/1.1 206" not in response_headers:
+            raise RuntimeError("Server does not support Range requests")
+
         # Store the end-of-track and format marker for this track (except if we are restarting a track)
         if offset == 0:
             if path.lower().endswith(".ts") or path.lower().endswith(".aac"):
@@ -544,6 +606,9 @@ class TrackReader:
         port = 80 if parts[0] == "http" else 443 if parts[0] == "https" else 0
         url = parts[1].split("/", 1)
         host = url[0]
+        if ":" in host:
+            host, port = host.split(":", 1)
+            port = int(port)
         path = url[1] if url[1].startswith("/") else "/" + url[1]
         return host, port, path
 
@@ -737,7 +802,9 @@ class TrackDecoder:
                     self.ParsedDecodeInfo.append([False, format_AAC, self.DecodeInfo[0][2]])
 
                     # Store the track info so that the player can init the I2S device at the beginning of the track
-                    self.context.player.Add_to_Play_List(channels, sample_rate, bits_per_sample, self.DecodeInfo[0][2])
+                    self.context.update_player(
+                        self.context.player.Add_to_Play_List, (channels, sample_rate, bits_per_sample, self.DecodeInfo[0][2])
+                    )
 
                     self.decode_phase = decode_phase_decoding
                     break
@@ -843,7 +910,7 @@ class TrackDecoder:
                         self.decode_phase = decode_phase_trackstart
 
                         # Update the player with the length of decoded audio for this track
-                        self.context.player.Update_Track_Length(self.current_track_bytes_decoder_out)
+                        self.context.update_player(self.context.player.Update_Track_Length, (self.current_track_bytes_decoder_out,))
                         self.ParsedDecodeInfo.pop(0)
 
                         # if len(self.playlist) > 0: doesn't work here as the read loop may have read the whole playlist while we're still decoding n tracks behind it
@@ -890,6 +957,7 @@ class TrackPlayer:
 
     def reset(self):
         self.play_phase = play_phase_idle
+        self.resume_phase = play_phase_playing  # The phase start() goes back to after a pause
 
         self.I2SAvailable = True
 
@@ -930,11 +998,18 @@ class TrackPlayer:
         if self.play_phase == play_phase_idle:
             self.play_phase = play_phase_start
         elif self.play_phase == play_phase_paused:
-            self.play_phase = play_phase_playing
+            # Carry on from the phase we paused in. A pause at the start of a track must still init the I2S device for it
+            self.play_phase = self.resume_phase
 
     def stop(self):
         self.play_phase = play_phase_idle
 
+    def pause(self):
+        # Keep our place in the track. start() carries on from here
+        if self.play_phase in (play_phase_start, play_phase_playing):
+            self.resume_phase = self.play_phase
+            self.play_phase = play_phase_paused
+
     def play_chunk(self):
         if not self.I2SAvailable or self.play_phase in (play_phase_idle, play_phase_paused) or len(self.PlayInfo) == 0:
             return
@@ -1020,6 +1095,7 @@ class TrackPlayer:
             # In this case we need to stop the player and wait for the decoder to fill up the InBuffer again
             if BytesToPlay == 0:
                 print("Player starved")
+                self.resume_phase = self.play_phase
                 self.play_phase = play_phase_paused
                 return
 
@@ -1041,20 +1117,34 @@ class TrackPlayer:
 
 
 class AudioPlayer:
-    def __init__(self, callbacks={}, debug=0):
+    def __init__(self, callbacks={}, debug=0, threaded_decode=False):
         self.callbacks = callbacks
         if "messages" not in callbacks.keys():
             self.callbacks["messages"] = lambda m: m
 
         self.DEBUG = debug
         self.pumptimer = Timer(0)
+
+        # In threaded mode the decoder runs in its own thread instead of the timer callback. Its messages are scheduled onto the main thread
+        self.threaded_decode = threaded_decode and _thread is not None
+        self.decode_thread_running = False
+        self.decode_thread_alive = False
+        self.reset_count = 0  # Player updates scheduled by the decode thread before a reset are dropped
+        decoder_callbacks = callbacks
+        if self.threaded_decode:
+            decoder_callbacks = dict(callbacks)
+            decoder_callbacks["messages"] = self.schedule_message
+
         self.reader = TrackReader(self, callbacks, debug)
-        self.decoder = TrackDecoder(self, callbacks, debug)
+        self.decoder = TrackDecoder(self, decoder_callbacks, debug)
         self.player = TrackPlayer(self, callbacks, debug)
 
         self.init_buffers()
         self.reset_player()
 
+        if self.threaded_decode:
+            self.start_decode_thread()
+
     def init_buffers(self):
         # A ringbuffer to hold packets from the network
         # As an example, a 96000 bps bitrate is 12kB per second, so a ten second buffer should be about 120kB
@@ -1084,8 +1174,9 @@ class AudioPlayer:
             self.reader.start()
 
     def start_timer(self):
+        self.pump_period = pump_period_default
         self.pumptimer = Timer(0)
-        self.pumptimer.init(period=10, mode=Timer.ONE_SHOT, callback=self.do_pump)
+        self.pumptimer.init(period=self.pump_period, mode=Timer.ONE_SHOT, callback=self.do_pump)
 
     def reset_player(self):
         self.DEBUG and print("Resetting Player")
@@ -1095,6 +1186,12 @@ class AudioPlayer:
             except:
                 pass
 
+        # Make sure the decode thread isn't part way through a decode while we reset everything underneath it
+        if not self.hold_decode_thread():
+            self.release_decode_thread()
+            raise RuntimeError("Decode thread didn't stop. Not resetting")
+        self.reset_count += 1
+
         self.reader.reset()
         self.decoder.reset()
         self.player.reset()
@@ -1108,8 +1205,110 @@ class AudioPlayer:
             raise AttributeError("Firmware is out of date")
         self.decoder.AACDecoder.AAC_Close()
 
+        self.release_decode_thread()
         print(self)
 
+    def start_decode_thread(self):
+        self.decode_thread_alive = True
+        self.decode_thread_running = True
+        self.decode_thread_hold = False
+        self.decode_thread_idle = False
+        _thread.start_new_thread(self.decode_worker, ())
+
+    def stop_decode_thread(self, timeout=1000):
+        # Returns True once the decode thread has finished
+        if not self.hold_decode_thread():
+            return False
+        self.decode_thread_running = False
+        return self.wait_decode_thread_exit(timeout)
+
+    def wait_decode_thread_exit(self, timeout=1000):
+        # The worker may still be sleeping after decode_thread_running goes False. Starting another before it has exited
+        # would put two decoders on the same ring buffers
+        TimeStart = time.ticks_ms()
+        while self.decode_thread_alive:
+            if time.ticks_diff(time.ticks_ms(), TimeStart) > timeout:
+                print("Decode thread didn't exit")
+                return False
+            time.sleep_ms(1)
+        return True
+
+    def hold_decode_thread(self, timeout=2000):
+        # Returns True once the decode thread is idle (or not running). decode_chunk() returns within 2 * pump_period_default, so the timeout only
+        # expires if the thread is stuck
+        if not self.decode_thread_running:
+            return True
+
+        self.decode_thread_hold = True
+        TimeStart = time.ticks_ms()
+        while not self.decode_thread_idle:
+            if time.ticks_diff(time.ticks_ms(), TimeStart) > timeout:
+                print("Decode thread didn't go idle")
+                return False
+            time.sleep_ms(1)
+        return True
+
+    def release_decode_thread(self):
+        if not self.decode_thread_running:
+            return
+
+        self.decode_thread_idle = False
+        self.decode_thread_hold = False
+
+    def decode_worker(self):
+        # The reader (in the pump) is the only writer to the InBuffer and the decoder is the only reader. The decoder is the only writer to the
+        # OutBuffer and the player (in the pump) is the only reader. So the ring buffers are single-producer/single-consumer and need no locks
+        print("Decode thread started")
+        try:
+            while self.decode_thread_running:
+                if self.decode_thread_hold:
+                    self.decode_thread_idle = True
+                    time.sleep_ms(pump_period_min)
+                    continue
+
+                if self.decoder.isRunning():
+                    self.decoder.decode_chunk(2 * pump_period_default)
+                    # Give the main thread a chance to run
+                    time.sleep_ms(1)
+                else:
+                    time.sleep_ms(pump_period_min)
+        except Exception as e:
+            print(f"Decode thread failed. {e}")
+            self.schedule_message(f"decode_worker: Decode error {e}")
+        finally:
+            self.decode_thread_running = False
+            self.decode_thread_idle = True
+            self.decode_thread_alive = False
+        print("Decode thread stopped")
+
+    def schedule_message(self, message):
+        # Callbacks from the decode thread are run on the main thread, so that they don't race with the UI
+        try:
+            micropython.schedule(self.callbacks["messages"], message)
+        except RuntimeError:
+            print(f"Message queue full, dropped: {message}")
+        return message
+
+    def update_player(self, update, args):
+        # PlayInfo belongs to the main thread. In threaded mode the decoder's updates to it are scheduled onto the main thread, in order,
+        # and never dropped, since the player needs every track's info and length
+        if not self.threaded_decode:
+            update(*args)
+            return
+
+        reset_count = self.reset_count
+        while not self.decode_thread_hold:
+            try:
+                micropython.schedule(self.run_player_update, (reset_count, update, args))
+                return
+            except RuntimeError:
+                time.sleep_ms(1)  # Queue full. Wait for the main thread to empty it
+
+    def run_player_update(self, scheduled):
+        reset_count, update, args = scheduled
+        if reset_count == self.reset_count:
+            update(*args)
+
     def init_vars(self):
         self.volume = 0
         self.sock = None
@@ -1167,6 +1366,10 @@ class AudioPlayer:
     def play(self):
         # Do not unmute here or you will hear a tiny bit of the previous track when ffwd/rewinding
         if self.audioplayer_state == audioplayer_state_Stopped:
+            if self.threaded_decode and not self.decode_thread_running:
+                if not self.wait_decode_thread_exit():
+                    raise RuntimeError("Decode thread didn't stop. Not starting another")
+                self.start_decode_thread()
             self.reader.start()
             self.audioplayer_state = audioplayer_state_Playing
         elif self.audioplayer_state == audioplayer_state_Playing:
@@ -1177,13 +1380,17 @@ class AudioPlayer:
         self.unmute_audio()
 
     def pause(self):
+        # Keep everything we have buffered. The reader stops once the InBuffer is full, and the server sees TCP backpressure.
+        # If the server gives up on us, the reader re-connects with a Range request when it next needs data
         if self.audioplayer_state == audioplayer_state_Playing:
             self.mute_audio()
-            self.player.stop()
+            self.player.pause()
             self.audioplayer_state = audioplayer_state_Paused
 
     def stop(self):
         self.mute_audio()
+        # The decode thread is started again by play()
+        self.stop_decode_thread()
         self.reset_player()
 
         if self.audioplayer_state == audioplayer_state_Stopped:
@@ -1206,16 +1413,33 @@ class AudioPlayer:
         return self.audioplayer_state == audioplayer_state_Playing
 
     def do_pump(self, _):
-        # Read the next chunk of data from the network
-        self.reader.read_chunk()
+        # Work out what is most urgent from the buffer levels. If the OutBuffer is getting low then play and decode first,
+        # and keep the reader to a single read so that it doesn't hold up the decoder
+        OutBufferLow = self.OutBuffer.any() < self.OutBufferSize // 4 and self.player.isRunning()
+
+        if OutBufferLow:
+            self.pump_play()
+            self.pump_decode(2 * pump_period_default)
+            self.reader.read_chunk()
+        else:
+            self.reader.read_chunk(read_bursts_max)
+            self.pump_decode()
+            self.pump_play()
+
+        self.pump_period = self.next_pump_period(OutBufferLow)
+        self.pumptimer.init(period=self.pump_period, mode=Timer.ONE_SHOT, callback=self.do_pump)
 
+    def pump_decode(self, timeout=pump_period_default):
         # Start the decode loop once we have more than 940 bytes (5 x .ts packets) in the InBuffer. No point starting decoding too early or the decoder can fail with insufficient data
         if not self.decoder.isRunning() and self.InBuffer.any() > 940 and self.audioplayer_state == audioplayer_state_Playing:
             print("Starting decoder")
             self.decoder.start()
 
-        self.decoder.decode_chunk()
+        # In threaded mode the decode thread calls decode_chunk(), we just start it
+        if not self.threaded_decode:
+            self.decoder.decode_chunk(timeout)
 
+    def pump_play(self):
         # Start the play loop if we have more than 1 second of output samples buffered (2 channels, 2 bytes per sample)
         if (
             not self.player.isRunning()
@@ -1227,4 +1451,20 @@ class AudioPlayer:
 
         self.player.play_chunk()
 
-        self.pumptimer.init(period=10, mode=Timer.ONE_SHOT, callback=self.do_pump)
+    def next_pump_period(self, OutBufferLow):
+        if OutBufferLow:
+            return pump_period_min
+
+        # Nothing is running, so there is nothing to do until play() is called
+        if not (self.reader.isRunning() or self.decoder.isRunning() or self.player.isRunning()):
+            return pump_period_max
+
+        # Sleep for longer when the decoder has no room to write, and the reader either has no room or nothing left to read.
+        # Don't sleep for more than a quarter of the audio in the OutBuffer (2 channels, 2 bytes per sample)
+        OutBufferFull = (self.OutBufferSize - self.OutBuffer.any()) < 8192
+        InBufferFull = (self.InBufferSize - self.InBuffer.any()) < self.reader.ReadBufferSize
+        if OutBufferFull and (InBufferFull or self.reader.sock is None):
+            SampleRate = self.player.PlayInfo[0][1] if len(self.player.PlayInfo) > 0 else 44100
+            return max(pump_period_default, min(pump_period_max, self.OutBuffer.any() * 250 // (SampleRate * 4)))
+
+        return pump_period_default
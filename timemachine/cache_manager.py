@@ -0,0 +1,320 @@
+"""
+litestream
+Copyright (C) 2026  spertilo.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Caches for the apps' metadata.
+#
+# DiskCache: one manager for the metadata the apps cache on flash (classical works and composers, rpm78 tracklists, ...).
+# Each entry is a json file written through metadata_store, in a namespace (usually the app), with an optional time
+# to live. All the entries share a byte budget, and the least recently used ones are evicted to stay within it, or to
+# leave enough of the disk free. The index is kept in memory, and saved when entries are added or removed, so looking
+# an entry up doesn't touch the file system until it is read.
+#
+#   works = disk_cache.get("classical", path)
+#   if works is None:
+#       works = request_json(url, path)  # which writes path
+#       disk_cache.add("classical", path, ttl=WORKS_TTL)
+#
+# LRUDict: a dict for metadata kept in memory, e.g. the works of the composers browsed so far, that drops the least
+# recently used entries when their approximate size passes a budget, or the heap runs low. With spill, json values are
+# written to the DiskCache when they are dropped, and read back if they are asked for again.
+#
+#   perf_dict = LRUDict(200_000, spill=("classical", lambda work_id: f"{METADATA_ROOT}/{work_id}.perf.json"))
+
+import gc
+import os
+import re
+import time
+from collections import OrderedDict
+
+import metadata_store
+import utils
+
+INDEX_PATH = "/metadata/cache_index.json"
+MAX_CACHE_BYTES = 2_000_000
+MIN_DISK_FREE = 500  # kbytes to leave for everything else
+# Caches written before there was an index, to take into it when it is first made. path -> namespace
+ADOPT_DIRS = {"/metadata/classical": "classical", "/metadata/78rpm": "rpm78"}
+KEEP_FILES = ("worklists.json",)  # Not cached metadata
+MIN_MEM_FREE = 100_000  # LRUDicts drop entries when the free heap is below this
+DEBUG = False
+
+
+class DiskCache:
+    def __init__(self, index_path=INDEX_PATH, max_bytes=MAX_CACHE_BYTES, min_disk_free=MIN_DISK_FREE):
+        self.index_path = index_path
+        self.max_bytes = max_bytes
+        self.min_disk_free = min_disk_free
+        self._index = None  # path -> {"ns", "size", "expires", "used"}
+        self._stats = {"hits": 0, "misses": 0, "expired": 0, "evicted": 0}
+
+    def _load(self):
+        if self._index is None:
+            try:
+                self._index = utils.read_json(self.index_path)
+            except Exception:
+                self._index = {}
+                self._adopt()
+        return self._index
+
+    def _adopt(self):
+        # No index yet, e.g. just after an upgrade. Index the cache files already on flash, so that they can be evicted
+        for directory, namespace in ADOPT_DIRS.items():
+            if not utils.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if (name in KEEP_FILES) or name.endswith("_tracknum.json"):
+                    continue
+                if not (name.endswith(".json") or name.endswith(".json" + metadata_store.GZ)):
+                    continue
+                stored = f"{directory}/{name}"
+                if utils.isdir(stored):
+                    continue
+                stat = os.stat(stored)
+                path = stored[: -len(metadata_store.GZ)] if name.endswith(metadata_store.GZ) else stored
+                self._index[path] = {"ns": namespace, "size": stat[6], "expires": None, "used": stat[7]}
+        print(f"DiskCache: adopted {len(self._index)} files")
+        self.make_room()  # Saves the index
+
+    def _save(self):
+        try:
+            utils.write_json(self._index, self.index_path)
+        except Exception as e:
+            print(f"DiskCache: failed to save index. {e}")
+
+    def _drop(self, path):
+        self._index.pop(path, None)
+        metadata_store.remove(path)
+
+    def get(self, namespace, path):
+        # The cached json at path, or None if it's not there or has expired
+        index = self._load()
+        entry = index.get(path)
+        if (entry is None) or (entry["ns"] != namespace):
+            self._stats["misses"] += 1
+            return None
+        if (entry["expires"] is not None) and (time.time() > entry["expires"]):
+            DEBUG and print(f"DiskCache: {path} expired")
+            self._stats["expired"] += 1
+            self._stats["misses"] += 1
+            self._drop(path)
+            self._save()
+            return None
+        try:
+            value = metadata_store.read(path)
+        except Exception as e:
+            print(f"DiskCache: failed to read {path}. {e}")
+            self._stats["misses"] += 1
+            self._drop(path)
+            self._save()
+            return None
+        entry["used"] = time.time()  # Saved with the next change to the index
+        self._stats["hits"] += 1
+        return value
+
+    def contains(self, namespace, path):
+        entry = self._load().get(path)
+        if (entry is None) or (entry["ns"] != namespace):
+            return False
+        return (entry["expires"] is None) or (time.time() <= entry["expires"])
+
+    def put(self, namespace, path, value, ttl=None, save=True):
+        metadata_store.write(value, path)
+        self.add(namespace, path, ttl, save)
+
+    def add(self, namespace, path, ttl=None, save=True):
+        # Add a file that has been written to path (through metadata_store), e.g. by archive_utils.get_request.
+        # With save=False the index is only changed in memory, to add several entries at once. Call make_room() after them
+        stored = metadata_store.stored_path(path)
+        if stored is None:
+            return
+        index = self._load()
+        index[path] = {
+            "ns": namespace,
+            "size": os.stat(stored)[6],
+            "expires": None if ttl is None else time.time() + ttl,
+            "used": time.time(),
+        }
+        if save:
+            self.make_room()
+
+    def remove(self, path):
+        index = self._load()
+        if path in index:
+            self._drop(path)
+            self._save()
+        else:
+            metadata_store.remove(path)
+
+    def clear(self, namespace=None, pattern=None):
+        # Remove the entries in namespace (or all of them), whose file names match the regex pattern, if given
+        index = self._load()
+        for path in list(index.keys()):
+            if (namespace is not None) and (index[path]["ns"] != namespace):
+                continue
+            if (pattern is not None) and not re.match(pattern, utils.basename(path)):
+                continue
+            self._drop(path)
+        self._save()
+
+    def total_bytes(self, namespace=None):
+        return sum(e["size"] for e in self._load().values() if (namespace is None) or (e["ns"] == namespace))
+
+    def make_room(self, nbytes=0, disk_free=None):
+        # Evict the least recently used entries until nbytes more fit in the budget, and disk_free kbytes
+        # (MIN_DISK_FREE by default) would be left on the disk. Returns False if that can't be done.
+        index = self._load()
+        disk_free = self.min_disk_free if disk_free is None else disk_free
+        total = self.total_bytes()
+        by_age = sorted(index.keys(), key=lambda path: index[path]["used"])
+        for path in by_age:
+            if (total + nbytes <= self.max_bytes) and (utils.disk_free() - nbytes / 1024 >= disk_free):
+                break
+            DEBUG and print(f"DiskCache: evicting {path}")
+            total -= index[path]["size"]
+            self._drop(path)
+            self._stats["evicted"] += 1
+        self._save()
+        return utils.disk_free() - nbytes / 1024 >= disk_free
+
+    def stats(self):
+        result = dict(self._stats)
+        index = self._load()
+        result["entries"] = len(index)
+        result["bytes"] = self.total_bytes()
+        namespaces = {}
+        for entry in index.values():
+            namespaces[entry["ns"]] = namespaces.get(entry["ns"], 0) + entry["size"]
+        result["namespaces"] = namespaces
+        return result
+
+
+disk_cache = DiskCache()
+
+
+def approx_size(obj):
+    # A rough guess at the bytes of heap obj uses, with what it contains. For when we don't know the length of the json it came from.
+    # Lists and dicts are guessed from their first item, rather than walking all of them
+    if isinstance(obj, str):
+        return 16 + len(obj)
+    if isinstance(obj, (list, tuple)):
+        return 16 + len(obj) * (4 + (approx_size(obj[0]) if obj else 0))
+    if isinstance(obj, dict):
+        if not obj:
+            return 32
+        key = next(iter(obj))
+        return 32 + len(obj) * (16 + approx_size(key) + approx_size(obj[key]))
+    if hasattr(obj, "__dict__"):
+        return 32 + approx_size(obj.__dict__)
+    return 8
+
+
+class LRUDict:
+    def __init__(self, max_bytes, min_mem_free=MIN_MEM_FREE, spill=None, ttl=None):
+        # spill is (namespace, path(key)), to keep dropped values in disk_cache for ttl seconds
+        self.max_bytes = max_bytes
+        self.min_mem_free = min_mem_free
+        self.spill = spill
+        self.ttl = ttl
+        self.bytes = 0
+        self._data = OrderedDict()  # key -> value, least recently used first
+        self._sizes = {}
+        self._stats = {"hits": 0, "misses": 0, "evicted": 0, "spilled": 0, "unspilled": 0}
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def keys(self):
+        return self._data.keys()
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        if key in self._data:
+            value = self._data.pop(key)
+            self._data[key] = value  # Now the most recently used
+            self._stats["hits"] += 1
+            return value
+        if self.spill is not None:
+            namespace, path = self.spill
+            value = disk_cache.get(namespace, path(key))
+            if value is not None:
+                self._stats["unspilled"] += 1
+                self[key] = value
+                return value
+        self._stats["misses"] += 1
+        return default
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, size=None):
+        # size is the length of the json value came from, if we know it. It is a good guess at the heap value takes, and cheaper to get
+        if key in self._data:
+            self.pop(key)
+        self._data[key] = value
+        self._sizes[key] = size if size else approx_size(value)
+        self.bytes += self._sizes[key]
+        self.trim()
+
+    def pop(self, key, default=None):
+        if key not in self._data:
+            return default
+        self.bytes -= self._sizes.pop(key)
+        return self._data.pop(key)
+
+    def clear(self):
+        self._data = OrderedDict()
+        self._sizes = {}
+        self.bytes = 0
+
+    def trim(self):
+        # Drop the least recently used entries, but never the last one added
+        spilled = 0
+        while len(self._data) > 1:
+            if self.bytes <= self.max_bytes:
+                if gc.mem_free() >= self.min_mem_free:
+                    break
+                gc.collect()
+                if gc.mem_free() >= self.min_mem_free:
+                    break
+            key = next(iter(self._data))
+            value = self.pop(key)
+            self._stats["evicted"] += 1
+            if self.spill is not None:
+                namespace, path = self.spill
+                try:
+                    disk_cache.put(namespace, path(key), value, self.ttl, save=False)
+                    spilled += 1
+                except Exception as e:
+                    print(f"LRUDict: failed to spill {key}. {e}")
+        if spilled:
+            self._stats["spilled"] += spilled
+            disk_cache.make_room()  # Saves the index once, for all the entries spilled
+
+    def stats(self):
+        result = dict(self._stats)
+        result["entries"] = len(self._data)
+        result["bytes"] = self.bytes
+        return result
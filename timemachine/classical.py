@@ -16,7 +16,6 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import os
 import re
 import time
 
@@ -26,6 +25,7 @@ import fonts.NotoSans_24 as pfont_med
 import board as tm
 import classical_utils as clu
 import utils
+from cache_manager import LRUDict, disk_cache
 from classical_utils import Composer, Genre, Work, Category
 from classical_utils import get_performances, get_composer_by_id, get_composers
 from classical_utils import ScreenContext
@@ -43,11 +43,14 @@ except ImportError as e:
 DEBUG = False
 CLASSICAL_API = "https://www.classicalarchives.com/ajax/cma-api-2.json"
 METADATA_ROOT = clu.METADATA_ROOT
+WORKS_CACHE_TTL = 3600 * 24 * 7  # 7 days
+WORKS_MEMORY = 100_000  # Approximate bytes of works to keep in memory
+CATS_MEMORY = 30_000
 
-works_dict = {}
+works_dict = LRUDict(WORKS_MEMORY)  # composer_id -> works, or (composer_id, category_id) -> works
 genres = []
 genre_dict = {}
-cat_dict = {}
+cat_dict = LRUDict(CATS_MEMORY)
 
 AUTO_PLAY = True
 COMPOSER_KEY_TIME = time.ticks_ms()
@@ -77,29 +80,30 @@ def get_creators(composer_list):  # A non-library mode call to get a list of com
         composer_list = [composer_list]
     url = f"{CLASSICAL_API}?action=creators"
     outpath = f"{METADATA_ROOT}/creators.json"
-    if utils.path_exists(outpath):
-        ALL_COMPOSERS = utils.read_json(outpath)
-    else:
+    ALL_COMPOSERS = disk_cache.get("classical", outpath)
+    if ALL_COMPOSERS is None:
         ALL_COMPOSERS = request_json(url, outpath)
+        disk_cache.add("classical", outpath, clu.COMPOSERS_CACHE_TTL)
     return ALL_COMPOSERS
 
 
 def get_works(composer_id):
-    global works_dict
     # Note: Keep a local cache (dictionary) of works by composer, but NOT a disk cache.
-    if composer_id in works_dict.keys():
-        return works_dict[composer_id]
+    works = works_dict.get(composer_id)
+    if works is not None:
+        return works
     url = f"{CLASSICAL_API}?action=works&creator_ids={composer_id}"
-    works = request_json(url)["works"]
+    j, size = request_json(url, with_size=True)
+    works = j["works"]
     # works_dict[composer_ids] = works
-    works_dict[composer_id] = [Work(id=w[0], name=w[1], genre=w[4], period=w[3], perf_id=w[5]) for w in works]
+    works_dict.set(composer_id, [Work(id=w[0], name=w[1], genre=w[4], period=w[3], perf_id=w[5]) for w in works], size)
     return works_dict[composer_id]
 
 
 def get_cats(composer_id):
-    global cat_dict
-    if composer_id in cat_dict.keys():
-        return cat_dict[composer_id]
+    cats = cat_dict.get(composer_id)
+    if cats is not None:
+        return cats
 
     if composer_id < 10:
         raise ValueError("Cannot get categories for composer id < 10")
@@ -118,17 +122,13 @@ def get_cat_works(glc):
 
 
 def uget_cat_works(composer_id, category):
-    global works_dict
     DEBUG and print(f"Getting works for {composer_id}, category {category.id}")
     # In this case, the works_dict requires 2 keys: Composer and Category.
-    if not composer_id in works_dict.keys():
-        works_dict[composer_id] = {}
-    works = works_dict[composer_id]
-    works = works.get(category.id, [])
+    works = works_dict.get((composer_id, category.id), [])
     if len(works) > 0:
         return works
 
-    cat_data = cat_dict.get(composer_id, [])
+    cat_data = get_cats(composer_id)  # It may have been dropped from cat_dict
     cat = [x for x in cat_data if x.id == category.id]
     if len(cat) == 0:
         raise ValueError(f"No data for composer {composer_id} and category {category.id}")
@@ -136,18 +136,13 @@ def uget_cat_works(composer_id, category):
         cat = cat[0]
     filepath = f"{METADATA_ROOT}/{composer_id}_{category.id}.works.json"
     DEBUG and print(f"filepath is {filepath}")
-    if utils.path_exists(filepath):
-        cache_expiry = 3600 * 24 * 7  # 7 days
-        if (time.time() - os.stat(filepath)[7]) < cache_expiry:
-            j = utils.read_json(filepath)
-        else:
-            utils.remove_file(filepath)
-
-    if not utils.path_exists(filepath):
+    j = disk_cache.get("classical", filepath)
+    if j is None:
         url = f"{CLASSICAL_API}?mode=library&action=work&composer_id={composer_id}" + (
             f"&category_id={category.id}" if category.id is not None else ""
         )
         j = request_json(url, filepath)
+        disk_cache.add("classical", filepath, WORKS_CACHE_TTL)
 
     works = [Work(**(x | {"index": i})) for i, x in enumerate([x for x in j if x["type"] != "c"])]
     # if depth < 0:
@@ -159,7 +154,7 @@ def uget_cat_works(composer_id, category):
     if len(works) == 0:
         print("EMPTY CATEGORY!!!")
     else:
-        works_dict[composer_id][category.id] = works
+        works_dict[(composer_id, category.id)] = works
     return works
 
 
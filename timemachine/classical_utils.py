@@ -1,5 +1,6 @@
 import json
 import network
+import os
 import re
 import time
 import utils
@@ -10,6 +11,8 @@ import fonts.NotoSans_18 as pfont_small
 import fonts.NotoSans_bold_18 as pfont_bold
 import fonts.NotoSans_24 as pfont_med
 
+from cache_manager import LRUDict, disk_cache
+
 try:
     from async_urequests import urequests as requests
 except ImportError:
@@ -18,15 +21,22 @@ except ImportError:
 METADATA_ROOT = "/metadata/classical"
 CLASSICAL_API = "https://www.classicalarchives.com/ajax/cma-api-2.json"
 TOKEN_FILE = "/metadata/classical/token.txt"
+COMPOSERS_CACHE_TTL = 3600 * 24 * 30  # 30 days
+PERFORMANCES_MEMORY = 200_000  # Approximate bytes of performance lists to keep in memory
+PERFORMANCES_CACHE_TTL = 3600 * 24 * 7  # Lists dropped from memory are kept on flash this long
 PLAYLIST_IDS = {}
 FAVORITE_PERFORMANCES = []
 FAVORITE_WORKS = []
 ACCESS_TOKEN = ""
-perf_dict = {}
+perf_dict = LRUDict(
+    PERFORMANCES_MEMORY,
+    spill=("classical", lambda work_id: f"{METADATA_ROOT}/{work_id}.perf.json"),
+    ttl=PERFORMANCES_CACHE_TTL,
+)
 
 
 # ------------------------------------------------------------------------------------ API requests
-def request_json(url, outpath="/tmp.json", debug=False):
+def request_json(url, outpath="/tmp.json", debug=False, with_size=False):
     url0 = url
     # state = load_state()
     # if len(state["access_token"]) > 0 and not "access_token" in url0:
@@ -34,7 +44,7 @@ def request_json(url, outpath="/tmp.json", debug=False):
         url = f"{url0}&access_token={ACCESS_TOKEN}"
     if debug:
         print(f"request_json: url: {url}")
-    json_resp = archive_utils.get_request(url, outpath=outpath)
+    json_resp = archive_utils.get_request(url, outpath=outpath, with_size=with_size)
     return json_resp
 
 
@@ -110,20 +120,15 @@ def get_composers(composer_list, match_field="lnu", beyond_notable=False):
     full_outpath = f"{METADATA_ROOT}/composers_all.json"
     outpath = full_outpath if beyond_notable else f"{METADATA_ROOT}/composers.json"
     composers = []
-    if utils.path_exists(outpath):
-        ALL_COMPOSERS = utils.read_json(outpath)
-    else:
-        if utils.path_exists(full_outpath):
-            try:
-                ALL_COMPOSERS = utils.read_json(full_outpath)
-            except Exception as e:
-                utils.remove_file(full_outpath)
-                ALL_COMPOSERS = request_json(url, outpath=full_outpath)
-        else:
+    ALL_COMPOSERS = disk_cache.get("classical", outpath)
+    if ALL_COMPOSERS is None:
+        ALL_COMPOSERS = disk_cache.get("classical", full_outpath)
+        if ALL_COMPOSERS is None:
             ALL_COMPOSERS = request_json(url, outpath=full_outpath)
+            disk_cache.add("classical", full_outpath, COMPOSERS_CACHE_TTL)
         if not beyond_notable:
             ALL_COMPOSERS = [x for x in ALL_COMPOSERS if x["nc"]]  # Notable only
-            utils.write_json(ALL_COMPOSERS, outpath)
+            disk_cache.put("classical", outpath, ALL_COMPOSERS, COMPOSERS_CACHE_TTL)
 
     for composer in composer_list:
         if composer == "GREATS":
@@ -150,9 +155,9 @@ def get_composers(composer_list, match_field="lnu", beyond_notable=False):
     if match_field == "name" and beyond_notable:
         print(f"Adding {composers} to {outpath}")
         outpath = f"{METADATA_ROOT}/composers.json"
-        ALL_COMPOSERS = utils.read_json(outpath)
+        ALL_COMPOSERS = disk_cache.get("classical", outpath) or []
         ALL_COMPOSERS += composers
-        utils.write_json(ALL_COMPOSERS, outpath)
+        disk_cache.put("classical", outpath, ALL_COMPOSERS, COMPOSERS_CACHE_TTL)
 
     composers = [Composer(x) for x in [x for x in composers if len(x["lnu"]) > 0]]
     return composers
@@ -310,6 +315,39 @@ favored_names = {
     # "Maazel": 60,
     # "Haitink": 60,
 }
+_favored_regex = None  # One pattern for all of favored_names, in lower case. See set_favored_names
+_favored_values = {}  # lower case name -> value
+
+
+def set_favored_names(names):
+    # Build the matcher once, rather than matching each favored name in turn for every performer
+    global favored_names, _favored_regex, _favored_values
+    favored_names = names
+    _favored_values = {name.lower(): value for name, value in names.items()}
+    # The names are plain text (letters and spaces), so they go into the pattern as they are
+    _favored_regex = re.compile("|".join(_favored_values.keys())) if _favored_values else None
+
+
+def performer_promotion(name):
+    # The total value of the favored names in name, each counted once
+    if _favored_regex is None:
+        if not favored_names:
+            return 0
+        set_favored_names(favored_names)
+    rest = name.lower()
+    promotion = 0
+    found = None
+    while True:
+        match = _favored_regex.search(rest)
+        if match is None:
+            return promotion
+        matched = match.group(0)
+        if found is None:
+            found = []
+        if matched not in found:
+            found.append(matched)
+            promotion += _favored_values[matched]
+        rest = rest[rest.find(matched) + len(matched) :]
 
 
 @micropython.native
@@ -326,9 +364,7 @@ def score(perf, track_counts_mode=(0, 0)):
     try:
         perf_info = perf.get("performers", [{"type": "Unknown", "name": "Unknown"}])
         for performer_item in perf_info:
-            for favored_name, favored_value in favored_names.items():
-                if re.search(favored_name.lower(), performer_item.get("name", "").lower()):
-                    promotion += favored_value
+            promotion += performer_promotion(performer_item.get("name", ""))
         # date = int(perf.get("release_date", "1900-01-01").replace("-", ""))
     except ValueError:
         pass
@@ -336,17 +372,17 @@ def score(perf, track_counts_mode=(0, 0)):
 
 
 def get_performances(work):
-    global perf_dict
     if isinstance(work, Work):
         work_id = work.id
     elif isinstance(work, int):
         work_id = work
 
-    if work_id in perf_dict.keys():
-        return perf_dict[work_id]
+    performances = perf_dict.get(work_id)
+    if performances is not None:
+        return performances
 
     url = f"{CLASSICAL_API}?mode=library&action=perf&work_id={work_id}"
-    performances = request_json(url)
+    performances, size = request_json(url, with_size=True)
     track_counts = [perf.get("trk", 0) for perf in performances[:35]]  # for symphonies prefer 4 tracks generally
     # compute bimodal track counts if one of the modes is 1 track (e.g. Eugene Onegin)
     track_counts_set = set(track_counts)
@@ -362,7 +398,10 @@ def get_performances(work):
         track_counts_mode = max(track_counts_set, key=track_counts.count)
         track_counts_mode = (track_counts_mode, max(track_counts_set - {1, 2}, key=track_counts.count))
     print(f"getting performances, before sorting {time.ticks_ms()}. Track counts mode is {track_counts_mode}")
-    performances = sorted(performances[:30], key=lambda perf: score(perf, track_counts_mode), reverse=True) + performances[30:]
+    # Score each performance once. sort calls the key function on every comparison
+    scored = [(score(perf, track_counts_mode), -i) for i, perf in enumerate(performances[:30])]
+    scored.sort(reverse=True)
+    performances = [performances[-i] for _, i in scored] + performances[30:]
     if work_id in FAVORITE_WORKS:  # Promote a favorite performance to the top of the list, regardless of score.
         for i, p in enumerate(performances):
             if p["p_id"] in FAVORITE_PERFORMANCES:
@@ -370,7 +409,7 @@ def get_performances(work):
                 break
 
     print(f"{time.ticks_ms()}. Top score {score(performances[0],track_counts_mode)}, {performances[0].get('trk',0)} tracks")
-    perf_dict[work_id] = performances
+    perf_dict.set(work_id, performances, size)
     return performances
 
 
@@ -568,8 +607,14 @@ def set_worklist_dict(key, val):
 
 
 # ------------------------------------------------------------------------------------ cache management
-def clear_cache(pattern=".*"):
-    utils.remove_files(f"{METADATA_ROOT}/{pattern}")
+def clear_cache(pattern=None):
+    disk_cache.clear("classical", pattern)
+    # And anything the cache doesn't know about, but not the account or the worklists
+    for name in os.listdir(METADATA_ROOT) if utils.isdir(METADATA_ROOT) else []:
+        if name in ("token.txt", "worklists.json"):
+            continue
+        if (pattern is None) or re.match(pattern, name):
+            utils.remove_file(f"{METADATA_ROOT}/{name}")
 
 
 # ------------------------------------------------------------------------------------ knobs
@@ -33,7 +33,10 @@ import fonts.NotoSans_32 as pfont_large
 
 import archive_utils
 import board as tm
+import json_stream
+import metadata_store
 import utils
+from cache_manager import disk_cache
 
 import audioPlayer
 
@@ -75,12 +78,12 @@ def get_artist_tapes(artist, state={}):
     if state != {}:
         range_index, range_size = state["artist_ind_range"].get(artist, (0, None))
     if utils.isdir(path):
-        range_size = len([x for x in os.listdir(path) if x.endswith(".json")])
+        range_size = len([x for x in os.listdir(path) if x.endswith(".json") or x.endswith(".json.gz")])
         state = utils.load_state("datpiff")
         state["artist_ind_range"][artist] = (range_index, range_size)
         utils.save_state(state, "datpiff")
         path = f"{path}/{artist}_{range_index:02d}.json"
-    return utils.read_json(path)
+    return metadata_store.read(path)
 
 
 @micropython.native
@@ -147,8 +150,10 @@ def set_knob_times():
 
 
 def get_tape_metadata(identifier):
-    url_download = f"https://archive.org/download/{identifier}"
-    j = archive_utils.get_tape_metadata(identifier)
+    url_download = f"{archive_utils.ARCHIVE_URL}/download/{identifier}"
+    j = archive_utils.get_tape_metadata(
+        identifier, ["files[*].format", "files[*].album", "files[*].artist", "files[*].title", "files[*].name"]
+    )
 
     track_data = [x for x in j["files"] if "mp3" in x["format"].lower()]
     tracklist = []
@@ -172,9 +177,9 @@ def load_tape_ids(artists):
     tape_ids = {}
     for artist in artists:
         id_path = f"/metadata/datpiff/{artist}.json"
-        if not utils.path_exists(id_path):
+        if not metadata_store.exists(id_path):
             download_tape_ids(artist, id_path)
-        tape_ids[artist] = json.load(open(id_path, "r"))
+        tape_ids[artist] = metadata_store.read(id_path)
 
     return tape_ids
 
@@ -525,13 +530,13 @@ def get_artist_metadata(artist_list):
     for artist in artist_list:
         path_to_meta = f"/metadata/datpiff/{artist}.json"
         need_to_download = False
-        if not utils.path_exists(path_to_meta):
+        if not metadata_store.exists(path_to_meta):
             need_to_download = True
         elif utils.isdir(path_to_meta) and not utils.path_exists(f"{path_to_meta}/completed"):
             need_to_download = True
             utils.remove_dir(path_to_meta)
         if need_to_download:
-            if utils.disk_free() < 3_000:
+            if not disk_cache.make_room(disk_free=3_000):  # Evict cached metadata before giving up
                 state = utils.load_state("datpiff")
                 state["artist_list"] = [x for x in artist_list if not x == artist]
                 utils.save_state(state, "datpiff")
@@ -549,45 +554,38 @@ def get_artist_metadata(artist_list):
                     state["artist_list"] = sorted(artist_list)
                     utils.save_state(state, "datpiff")
                     continue
-                if resp.chunked:
-                    print("saving json to /tmp.json")
-                    resp.save("/tmp.json")
-                    resp.close()
-                    metadata = json.load(open("/tmp.json", "r"))
-                elif len(resp.text) > 1_000_000:
-                    print("saving json to /tmp.json")
-                    with open("/tmp.json", "w") as f:
-                        f.write(resp.text)
-                    resp.close()
-                    gc.collect()
-                    metadata = utils.read_json("/tmp.json")
-                    utils.remove_file("/tmp.json")
-                else:
-                    metadata = resp.json()
-
+                # Parse the list one element at a time and write it out in chunks as we go, so that we never hold the whole artist in memory
                 keys = ["artist", "title", "identifier"]
                 chunk_size = 1_600
-                if len(metadata) > chunk_size:
-                    if not utils.isdir(path_to_meta):
-                        utils.remove_file(path_to_meta)
-                        os.mkdir(path_to_meta)
-
-                    for chunk_i in range(1 + len(metadata) // chunk_size):
-                        sub_path = f"{path_to_meta}/{artist}_{chunk_i:02d}.json"
-                        end = min(chunk_size, len(metadata))
-                        chunk = metadata[:end]
-                        gc.collect()
-                        chunk = [dict(zip(keys, x)) for x in chunk]
-                        utils.write_json(chunk, sub_path)
-                        metadata = metadata[end:]
-                        print(f"len metadata is {len(metadata)}")
+                chunk = []
+                chunk_i = -1
+
+                def write_chunk():
+                    nonlocal chunk, chunk_i
+                    if chunk_i < 0:
+                        # More than one chunk, so this artist is stored as a directory
+                        if not utils.isdir(path_to_meta):
+                            metadata_store.remove(path_to_meta)
+                            os.mkdir(path_to_meta)
+                    chunk_i += 1
+                    metadata_store.write(chunk, f"{path_to_meta}/{artist}_{chunk_i:02d}.json")
+                    chunk = []
+                    gc.collect()
+
+                def add_tape(path, value):
+                    if len(chunk) == chunk_size:
+                        write_chunk()
+                    chunk.append(dict(zip(keys, value)))
+
+                json_stream.load(resp, ["[*]"], add_tape)
+                if chunk_i < 0:
+                    metadata_store.write(chunk, path_to_meta)
+                else:
+                    write_chunk()
                     utils.touch(f"{path_to_meta}/completed")
                     state = utils.load_state("datpiff")
                     state["artist_ind_range"][artist] = (0, chunk_i)
                     utils.save_state(state, "datpiff")
-                else:
-                    metadata = [dict(zip(keys, x)) for x in metadata]
-                    utils.write_json(metadata, path_to_meta)
             except Exception as e:
                 print(f"Exception in getting artist metadata: {e}")
                 raise e
@@ -0,0 +1,131 @@
+"""
+litestream
+Copyright (C) 2026  spertilo.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Ask a primary source (e.g. the cloud bucket) and fall back to a second one (e.g. the API) without waiting for the
+# primary to fail first. primary and fallback are functions returning a coroutine, which returns the result, or None
+# for a miss (e.g. a 404). Exceptions count as misses.
+#
+# We keep the latency and miss rate of each primary, by key. If the primary usually answers, the fallback is only
+# started if the primary is slower than usual (a hedged request). If it usually misses, both are started at once.
+# The first valid result wins, and the other request is cancelled.
+#
+# The latency is that of the whole coroutine, body and parsing included, so only hedge requests with small bodies
+# (e.g. tape_ids, track_urls). A hedge on a large body would download it twice, and hold both in the heap.
+
+import time
+import uasyncio as asyncio
+
+ALPHA = 0.2  # Weight of the latest request in the moving averages
+MIN_HEDGE_DELAY = 150  # ms
+MAX_HEDGE_DELAY = 3_000  # ms
+HEDGE_FACTOR = 2  # Hedge when the primary takes this many times longer than usual
+RACE_MISS_RATE = 0.5  # Start both at once when the primary misses more often than this
+DEBUG = False
+
+_stats = {}  # key -> {"latency": ms, "miss_rate": 0-1, "n": requests, "hedged": n, "fallback_won": n}
+
+
+def stats(key=None):
+    return _stats if key is None else _stats.get(key)
+
+
+def _get_stats(key):
+    if key not in _stats:
+        _stats[key] = {"latency": MAX_HEDGE_DELAY / HEDGE_FACTOR, "miss_rate": 0.0, "n": 0, "hedged": 0, "fallback_won": 0}
+    return _stats[key]
+
+
+def _record(stat, elapsed, miss):
+    # The latency is that of hits only. Misses (e.g. a quick 404) would pull it down until every normal hit was hedged.
+    # miss is None when the request was cancelled, and we only know that it took at least elapsed
+    stat["n"] += 1
+    if miss is None:
+        if elapsed > stat["latency"]:
+            stat["latency"] += ALPHA * (elapsed - stat["latency"])
+        return
+    if not miss:
+        stat["latency"] += ALPHA * (elapsed - stat["latency"])
+    stat["miss_rate"] += ALPHA * ((1.0 if miss else 0.0) - stat["miss_rate"])
+
+
+def hedge_delay(key):
+    stat = _get_stats(key)
+    return min(max(HEDGE_FACTOR * stat["latency"], MIN_HEDGE_DELAY), MAX_HEDGE_DELAY)
+
+
+async def hedged(primary, fallback, key="default"):
+    stat = _get_stats(key)
+    done = asyncio.Event()
+    results = {}  # name -> result, once finished
+    tasks = {}
+
+    async def run(name, request):
+        start = time.ticks_ms()
+        try:
+            result = await request()
+        except asyncio.CancelledError:
+            if name == "primary":
+                _record(stat, time.ticks_diff(time.ticks_ms(), start), None)
+            raise
+        except Exception as e:
+            print(f"hedged {key} {name}: {e}")
+            result = None
+        if name == "primary":
+            _record(stat, time.ticks_diff(time.ticks_ms(), start), result is None)
+        results[name] = result
+        done.set()
+
+    def start(name, request):
+        tasks[name] = asyncio.create_task(run(name, request))
+
+    def winner():
+        for name in ("primary", "fallback"):
+            if results.get(name) is not None:
+                return name
+        return None
+
+    start("primary", primary)
+    if stat["miss_rate"] > RACE_MISS_RATE:
+        DEBUG and print(f"hedged {key}: racing")
+        start("fallback", fallback)
+    else:
+        try:
+            await asyncio.wait_for_ms(done.wait(), int(hedge_delay(key)))
+        except asyncio.TimeoutError:
+            DEBUG and print(f"hedged {key}: primary slow, hedging")
+            stat["hedged"] += 1
+
+    while True:
+        name = winner()
+        if name is not None:
+            break
+        if len(results) == len(tasks):
+            if "fallback" in tasks:
+                return None  # Both missed
+            start("fallback", fallback)  # The primary missed before we hedged
+        elif "fallback" not in tasks:
+            start("fallback", fallback)  # The hedge delay passed
+        done.clear()
+        await done.wait()
+
+    for other, task in tasks.items():
+        if other != name and other not in results:
+            task.cancel()
+    if name == "fallback":
+        stat["fallback_won"] += 1
+    return results[name]
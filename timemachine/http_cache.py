@@ -0,0 +1,219 @@
+"""
+litestream
+Copyright (C) 2026  spertilo.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# A disk-backed cache for GETs of metadata that rarely changes (vcs, tape_ids, trackdata, collection names).
+# Bodies are stored on flash with their ETag/Last-Modified. The next request for the same url is conditional, and a
+# 304 is answered from flash. get() (or aget() from a coroutine) returns something that looks enough like an mrequests
+# Response for the callers: status_code, json(), text and close(). Responses other than 200/304 are returned as they came, so 404 handling is unchanged.
+
+import binascii
+import hashlib
+import json
+import os
+import time
+
+import utils
+from mrequests import mrequests as requests
+
+CACHE_DIR = "/metadata/http_cache"
+INDEX_PATH = f"{CACHE_DIR}/index.json"
+MAX_CACHE_BYTES = 3_000_000  # Evict the least recently used bodies beyond this
+MIN_DISK_FREE = 500  # kbytes to leave for everything else
+DEBUG = False
+
+_index = None  # url -> {"file", "etag", "modified", "size", "used"}
+
+
+class CachedResponse:
+    def __init__(self, path, from_cache):
+        self.path = path
+        self.from_cache = from_cache
+        self.status_code = 200
+        self.chunked = False
+
+    def json(self):
+        with open(self.path, "r") as f:
+            return json.load(f)
+
+    @property
+    def text(self):
+        with open(self.path, "r") as f:
+            return f.read()
+
+    def close(self):
+        pass
+
+
+def _load_index():
+    global _index
+    if _index is None:
+        try:
+            _index = utils.read_json(INDEX_PATH)
+        except Exception:
+            _index = {}
+    return _index
+
+
+def _save_index():
+    utils.write_json(_index, INDEX_PATH)
+
+
+def _body_path(url):
+    return f"{CACHE_DIR}/{binascii.hexlify(hashlib.sha256(url.encode()).digest()[:8]).decode()}.json"
+
+
+def _header(resp, name):
+    # resp.headers is the list of raw header lines, e.g. b'ETag: "abc"\r\n'
+    name = name.lower()
+    for line in resp.headers or []:
+        key, _, value = line.partition(b":")
+        if key.strip().lower() == name:
+            return value.strip().decode()
+    return None
+
+
+def remove(url):
+    index = _load_index()
+    entry = index.pop(url, None)
+    if entry is not None:
+        utils.remove_file(entry["file"])
+        _save_index()
+
+
+def clear():
+    global _index
+    utils.remove_dir(CACHE_DIR)
+    _index = {}
+
+
+def cache_size():
+    return sum(entry["size"] for entry in _load_index().values())
+
+
+def evict(need=0, keep=None):
+    # Drop the least recently used bodies, other than keep's, until there is room for need more bytes, both in our budget and on the disk
+    index = _load_index()
+    by_age = sorted(index.keys(), key=lambda url: index[url]["used"])
+    total = cache_size()
+    for url in by_age:
+        if (total + need <= MAX_CACHE_BYTES) and (utils.disk_free() - need / 1024 > MIN_DISK_FREE):
+            break
+        if url == keep:
+            continue
+        entry = index.pop(url)
+        DEBUG and print(f"http_cache evicting {url}")
+        utils.remove_file(entry["file"])
+        total -= entry["size"]
+    _save_index()
+
+
+def _lookup(url):
+    # Returns the index entry for url, and the headers to make the request conditional on it
+    index = _load_index()
+    entry = index.get(url)
+    if (entry is not None) and not utils.path_exists(entry["file"]):
+        index.pop(url)
+        entry = None
+
+    headers = {}
+    if entry is not None:
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["modified"]:
+            headers["If-Modified-Since"] = entry["modified"]
+    return entry, headers
+
+
+def _not_modified(url, entry):
+    DEBUG and print(f"http_cache: {url} not modified")
+    entry["used"] = time.time()  # Saved with the next change to the index, rather than writing flash on every 304
+    return CachedResponse(entry["file"], True)
+
+
+def _store(url, etag, modified, write):
+    # write(path) puts the body on flash. Returns the path, or None if there was nothing to revalidate with
+    if (etag is None) and (modified is None):
+        return None
+    index = _load_index()
+    # We don't know how big the body is until it is written, so leave MIN_DISK_FREE now, and come back to the budget after
+    evict()
+    path = _body_path(url)
+    utils.mkdirs(CACHE_DIR)
+    try:
+        write(path)
+    except Exception as e:
+        utils.remove_file(path)
+        index.pop(url, None)
+        _save_index()
+        raise e
+    index[url] = {"file": path, "etag": etag, "modified": modified, "size": os.stat(path)[6], "used": time.time()}
+    evict(keep=url)  # Saves the index
+    return path
+
+
+def get(url):
+    entry, headers = _lookup(url)
+    try:
+        resp = requests.get(url, headers=headers, save_headers=True)
+    except OSError as e:
+        if entry is None:
+            raise
+        # Offline. A stale copy is better than nothing
+        print(f"http_cache: {e} getting {url}. Using cached copy")
+        return CachedResponse(entry["file"], True)
+
+    if (resp.status_code == 304) and (entry is not None):
+        resp.close()
+        return _not_modified(url, entry)
+
+    if resp.status_code != 200:
+        return resp
+
+    path = _store(url, _header(resp, b"etag"), _header(resp, b"last-modified"), resp.save)
+    if path is None:
+        return resp
+    return CachedResponse(path, False)
+
+
+async def aget(url, timeout=100):
+    # The same, with async_urequests, so that several urls can be fetched at once.
+    # The body is in memory already, so a 200 is returned as it is once it has been stored.
+    import async_urequests
+
+    entry, headers = _lookup(url)
+    try:
+        resp = await async_urequests.get(url, headers=headers, timeout=timeout)
+    except (OSError, async_urequests.ConnectionError, async_urequests.TimeoutError) as e:
+        if entry is None:
+            raise
+        print(f"http_cache: {e} getting {url}. Using cached copy")
+        return CachedResponse(entry["file"], True)
+
+    if (resp.status_code == 304) and (entry is not None):
+        return _not_modified(url, entry)
+
+    if resp.status_code != 200:
+        return resp
+
+    def write(path):
+        with open(path, "wb") as f:
+            f.write(resp.content)
+
+    response_headers = {k.lower(): v for k, v in resp.headers.items()}
+    _store(url, response_headers.get("etag"), response_headers.get("last-modified"), write)
+    return resp
@@ -0,0 +1,301 @@
+"""
+litestream
+Copyright (C) 2026  spertilo.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# An incremental JSON reader for http responses (or anything else with a read(size) method).
+# Only the parts of the document named in paths are built, the rest is skipped as it arrives, so we never hold the whole body in memory
+# or write it to flash. Paths look like "total", "items[*].identifier" or "files[*]". [*] matches each element of an array, never the keys
+# of an object. A path that names a container keeps all of it.
+#
+#   load(resp, ["count", "total", "cursor", "items[*].identifier"])
+#       -> {"count": 2, "total": 2, "cursor": "...", "items": [{"identifier": "a"}, {"identifier": "b"}]}
+#
+# With on_value, matching values are passed to on_value(path, value) as they are parsed instead of being returned, e.g. ("items", 0, "identifier"), "a"
+
+import json
+
+WHITESPACE = (32, 9, 13, 10)
+SCALAR_END = (b" ", b"\t", b"\r", b"\n", b",", b"]", b"}")
+SCALAR_WINDOW = 32  # Numbers, true, false and null are short, so look for their end this far ahead at a time
+SKIP_CHARS = (b'"', b"{", b"[", b"}", b"]")  # What matters when skipping a container. The openings come before the closings
+
+
+def parse_paths(paths):
+    # "items[*].identifier" -> ["items", "*", "identifier"]
+    parsed = []
+    for path in paths:
+        keys = []
+        for part in path.split("."):
+            name = part.replace("[*]", "")
+            if name:
+                keys.append(name)
+            keys.extend(["*"] * part.count("[*]"))
+        parsed.append(keys)
+    return parsed
+
+
+def load(stream, paths=None, on_value=None, chunk_size=1024):
+    reader = JsonReader(stream, chunk_size)
+    if paths is None:
+        value = reader.parse_value()
+        if on_value is not None:
+            on_value((), value)
+            return None
+        return value
+    found, value = reader.walk(parse_paths(paths), on_value)
+    return value
+
+
+class JsonReader:
+    def __init__(self, stream, chunk_size=1024):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buf = b""
+        self.pos = 0
+        self.path = []
+
+    def fill(self):
+        # Returns False at the end of the stream
+        if self.pos < len(self.buf):
+            return True
+        self.buf = self.stream.read(self.chunk_size)
+        self.pos = 0
+        return bool(self.buf)
+
+    def peek(self):
+        # The next non-whitespace byte, without consuming it
+        while True:
+            if not self.fill():
+                raise ValueError("Unexpected end of JSON")
+            c = self.buf[self.pos]
+            if c in WHITESPACE:
+                self.pos += 1
+            else:
+                return c
+
+    def expect(self, ch):
+        if self.peek() != ch:
+            raise ValueError(f"Expected {chr(ch)} in JSON, got {chr(self.buf[self.pos])}")
+        self.pos += 1
+
+    def next_item(self, close):
+        # After a value in an object or array. Returns False when we reach the closing bracket
+        c = self.peek()
+        self.pos += 1
+        if c == ord(","):
+            return True
+        if c == close:
+            return False
+        raise ValueError(f"Expected , or {chr(close)} in JSON, got {chr(c)}")
+
+    def read_string(self, keep=True):
+        # Assumes we are on the opening quote. Escapes are left for json.loads() to decode
+        self.expect(ord('"'))
+        pieces = []
+        escaped = False
+        while True:
+            if not self.fill():
+                raise ValueError("Unterminated string in JSON")
+            buf = self.buf
+            end = buf.find(b'"', self.pos)
+            if end < 0:
+                end = len(buf)
+            backslash = buf.find(b"\\", self.pos, end)
+            if backslash >= 0:
+                # Keep the backslash and the character after it, which may be a quote
+                escaped = True
+                if backslash + 1 < len(buf):
+                    keep and pieces.append(buf[self.pos : backslash + 2])
+                    self.pos = backslash + 2
+                else:
+                    keep and pieces.append(buf[self.pos :])
+                    self.pos = len(buf)
+                    self.fill()
+                    keep and pieces.append(self.buf[self.pos : self.pos + 1])
+                    self.pos += 1
+                continue
+            keep and pieces.append(buf[self.pos : end])
+            self.pos = end
+            if end < len(buf):
+                self.pos += 1
+                break
+
+        if not keep:
+            return None
+        raw = b"".join(pieces)
+        if escaped:
+            return json.loads(b'"' + raw + b'"')
+        return raw.decode()
+
+    def read_scalar(self, keep=True):
+        pieces = []
+        while self.fill():
+            buf = self.buf
+            end = -1
+            i = self.pos
+            while end < 0 and i < len(buf):
+                stop = min(i + SCALAR_WINDOW, len(buf))
+                for c in SCALAR_END:
+                    j = buf.find(c, i, stop)
+                    if j >= 0:
+                        end = stop = j
+                i = stop
+            if end < 0:
+                end = len(buf)
+            keep and pieces.append(buf[self.pos : end])
+            self.pos = end
+            if end < len(buf):
+                break
+
+        if not keep:
+            return None
+        raw = b"".join(pieces)
+        if raw == b"true":
+            return True
+        if raw == b"false":
+            return False
+        if raw == b"null":
+            return None
+        if b"." in raw or b"e" in raw or b"E" in raw:
+            return float(raw)
+        return int(raw)
+
+    def parse_value(self):
+        c = self.peek()
+        if c == ord("{"):
+            self.pos += 1
+            result = {}
+            if self.peek() == ord("}"):
+                self.pos += 1
+                return result
+            while True:
+                key = self.read_string()
+                self.expect(ord(":"))
+                result[key] = self.parse_value()
+                if not self.next_item(ord("}")):
+                    return result
+        if c == ord("["):
+            self.pos += 1
+            result = []
+            if self.peek() == ord("]"):
+                self.pos += 1
+                return result
+            while True:
+                result.append(self.parse_value())
+                if not self.next_item(ord("]")):
+                    return result
+        if c == ord('"'):
+            return self.read_string()
+        return self.read_scalar()
+
+    def skip_value(self):
+        c = self.peek()
+        if c == ord('"'):
+            self.read_string(keep=False)
+        elif c == ord("{") or c == ord("["):
+            self.skip_container()
+        else:
+            self.read_scalar(keep=False)
+
+    def skip_container(self):
+        # Count brackets until we are back out of this container, stepping over strings which could contain brackets.
+        # find() jumps from one of SKIP_CHARS to the next, and each is only looked for again once we have passed it
+        depth = 0
+        while True:
+            if not self.fill():
+                raise ValueError("Unexpected end of JSON")
+            buf = self.buf
+            found = [buf.find(c, self.pos) for c in SKIP_CHARS]
+            while True:
+                i = which = -1
+                for k in range(len(found)):
+                    if found[k] >= 0 and (i < 0 or found[k] < i):
+                        i = found[k]
+                        which = k
+                if i < 0:
+                    self.pos = len(buf)
+                    break
+                if which == 0:
+                    self.pos = i
+                    self.read_string(keep=False)
+                    if self.buf is not buf:
+                        break  # The string ran into the next chunk
+                else:
+                    self.pos = i + 1
+                    depth += 1 if which < 3 else -1
+                    if depth == 0:
+                        return
+                for k in range(len(found)):
+                    if 0 <= found[k] < self.pos:
+                        found[k] = buf.find(SKIP_CHARS[k], self.pos)
+
+    def walk(self, active, on_value=None, depth=0):
+        # active is the list of paths that match where we are. Returns (found, value)
+        for keys in active:
+            if len(keys) == depth:
+                value = self.parse_value()
+                if on_value is not None:
+                    on_value(tuple(self.path), value)
+                    return False, None
+                return True, value
+
+        c = self.peek()
+        if c == ord("{"):
+            self.pos += 1
+            result = {}
+            if self.peek() == ord("}"):
+                self.pos += 1
+                return True, result
+            while True:
+                key = self.read_string()
+                self.expect(ord(":"))
+                child = [keys for keys in active if keys[depth] == key]
+                if child:
+                    self.path.append(key)
+                    found, value = self.walk(child, on_value, depth + 1)
+                    self.path.pop()
+                    if found:
+                        result[key] = value
+                else:
+                    self.skip_value()
+                if not self.next_item(ord("}")):
+                    return True, result
+
+        if c == ord("["):
+            self.pos += 1
+            result = []
+            child = [keys for keys in active if keys[depth] == "*"]
+            if self.peek() == ord("]"):
+                self.pos += 1
+                return True, result
+            index = 0
+            while True:
+                if child:
+                    self.path.append(index)
+                    found, value = self.walk(child, on_value, depth + 1)
+                    self.path.pop()
+                    if found:
+                        result.append(value)
+                else:
+                    self.skip_value()
+                index += 1
+                if not self.next_item(ord("]")):
+                    return True, result
+
+        # A scalar where we expected a container
+        self.skip_value()
+        return False, None
@@ -17,20 +17,22 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import gc
+import random
 import re
 import time
+import uasyncio as asyncio
 from collections import OrderedDict
 
-try:
-    from async_urequests import urequests as requests
-except ImportError:
-    from mrequests import mrequests as requests
-
 # import micropython # Use micropython.mem_info() to see memory available.
 
+import async_urequests
 import archive_utils
 import board as tm
+import hedged_requests
+import http_cache
+import metadata_store
 import utils
+from show_index import ShowIndex
 
 import audioPlayer
 
@@ -52,7 +54,15 @@ API = "https://gratefuldeadtimemachine.com"  # google cloud version mapped to he
 AUTO_PLAY = True
 DATE_SET_TIME = time.ticks_ms()
 COLLS_LOADED_TIME = None
+POSITION_SAVE_TIME = time.ticks_ms()
+POSITION_SAVE_INTERVAL = 60_000
+SAVED_POSITION = None
 CONFIG_CHOICES = ["Artists"]
+MAX_WORKERS = 4
+VCS_WORKER_MEMORY = 150_000  # Rough heap needed for one vcs download in flight: the TLS buffers, the body and the parsed dict
+TAPE_IDS_WORKER_MEMORY = 60_000  # tape_ids are small, it's mostly the TLS buffers
+TIH_INDEX = {}
+VCS_DIR = "/metadata/livemusic/vcs"
 
 
 # --------------------------------------------------------------- Bboxes
@@ -91,6 +101,7 @@ def delete_from_collection_list(old_collection):
     state["collection_list"] = full_list
     if len(full_list) > 0:
         utils.save_state(state)
+        metadata_store.remove(f"{VCS_DIR}/{old_collection}.json")
     else:
         print("WARN tried to set collection list to empty. Bailing")
 
@@ -180,13 +191,12 @@ def select_date(coll_dict, key_date, ntape=0, collection=None, tape_id=None):
         ntape = ntape // len(valid_collections)
 
     tracklist = []
-    tape_ids_url = f"{CLOUD_PATH}/tapes/{collection}/{key_date}/tape_ids.json"
 
     if tape_id is not None:
         selected_tape_id = tape_id
         trackdata_url = f"{CLOUD_PATH}/tapes/{collection}/{key_date}/{tape_id}/trackdata.json"
         try:
-            resp = requests.get(trackdata_url)
+            resp = http_cache.get(trackdata_url)
             if resp.status_code == 200:
                 response = resp.json()
                 collection = response["collection"]
@@ -195,90 +205,128 @@ def select_date(coll_dict, key_date, ntape=0, collection=None, tape_id=None):
         finally:
             resp.close()
     if len(tracklist) == 0:
-        try:
-            resp = requests.get(tape_ids_url)
-            if resp.status_code == 200:
-                tape_ids = resp.json()
-                ntapes = len(tape_ids)
-                selected_tape_id = tape_ids[ntape % ntapes][0]
-                trackdata_url = f"{CLOUD_PATH}/tapes/{collection}/{key_date}/{selected_tape_id}/trackdata.json"
-                resp = requests.get(trackdata_url)
-                response = resp.json()
-                collection = response["collection"]
-                tracklist = response["tracklist"]
-                urls = response["urls"]
-            else:
-                api_request = f"{API}/track_urls/{key_date}?collections={collection}&ntape={ntape}"
-                print(f"API request is {api_request}")
-                resp = requests.get(api_request)
-                response = resp.json()
-                collection = response["collection"]
-                tracklist = response["tracklist"]
-                urls = response["urls"]
-                selected_tape_id = response.get("tape_id", "unknown")
-        finally:
-            resp.close()
+        response = asyncio.run(aget_track_urls(collection, key_date, ntape))
+        collection = response["collection"]
+        tracklist = response["tracklist"]
+        urls = response["urls"]
+        selected_tape_id = response.get("tape_id", "unknown")
     print(f"URLs: {urls}")
     if len(urls) == 0:
         print(f"no playable tracks found for {key_date} {collection} {selected_tape_id}")
     return collection, tracklist, urls, selected_tape_id
 
 
-def get_tape_ids(coll_dict, key_date):
+async def aget_track_urls(collection, key_date, ntape):
+    # The track data for the ntape'th tape, from the cloud bucket or the API, whichever answers first
+    async def from_cloud():
+        tape_ids_url = f"{CLOUD_PATH}/tapes/{collection}/{key_date}/tape_ids.json"
+        resp = await http_cache.aget(tape_ids_url)
+        if resp.status_code != 200:
+            return None
+        tape_ids = resp.json()
+        selected_tape_id = tape_ids[ntape % len(tape_ids)][0]
+        trackdata_url = f"{CLOUD_PATH}/tapes/{collection}/{key_date}/{selected_tape_id}/trackdata.json"
+        resp = await http_cache.aget(trackdata_url)
+        if resp.status_code != 200:
+            return None
+        response = resp.json()
+        response["tape_id"] = selected_tape_id
+        return response
+
+    async def from_api():
+        api_request = f"{API}/track_urls/{key_date}?collections={collection}&ntape={ntape}"
+        print(f"API request is {api_request}")
+        resp = await async_urequests.get(api_request)
+        return resp.json() if resp.status_code == 200 else None
+
+    response = await hedged_requests.hedged(from_cloud, from_api, "track_urls")
+    if response is None:
+        raise Exception(f"Failed to get track urls for {collection} on {key_date}")
+    return response
+
+
+async def aget_tape_ids(collection, key_date):
+    async def from_cloud():
+        url = f"{CLOUD_PATH}/tapes/{collection}/{key_date}/tape_ids.json"
+        print(f"URL is {url}")
+        resp = await http_cache.aget(url)
+        if resp.status_code != 200:
+            return None
+        return [[collection, x[0]] for x in resp.json()]
+
+    async def from_api():
+        api_request = f"{API}/tape_ids/{key_date}?collections={collection}"
+        print(f"api_request is {api_request}")
+        resp = await async_urequests.get(api_request)
+        if resp.status_code != 200:
+            return None
+        these_tape_ids = resp.json()[collection]
+        print(f"these_tape_ids is {these_tape_ids}")
+        if not isinstance(these_tape_ids, (list, tuple)):
+            these_tape_ids = [these_tape_ids]
+        return [[collection, x] for x in these_tape_ids]
+
+    tape_ids = await hedged_requests.hedged(from_cloud, from_api, "tape_ids")
+    if tape_ids is None:
+        raise Exception(f"Failed to get_tape_ids for {collection} on {key_date}")
+    return tape_ids
+
+
+def get_tape_ids(coll_dict, key_date, on_result=None):
+    # Fetch the tape_ids of every collection with a show on key_date at once.
+    # on_result(collection, tape_ids) is called as each collection answers, e.g. to show progress.
     print(f"getting tape_ids from {key_date}")
-    key_date_colls = []
-    tape_ids = []
-    for collection, cdict in coll_dict.items():
-        if cdict.get(key_date, None):
-            key_date_colls.append(collection)
-            url = f"{CLOUD_PATH}/tapes/{collection}/{key_date}/tape_ids.json"
-            print(f"URL is {url}")
-            try:
-                resp = None
-                resp = requests.get(url)
-                if resp.status_code == 200:
-                    tape_ids = tape_ids + [[collection, x[0]] for x in resp.json()]
-                elif resp.status_code == 404:
-                    api_request = f"{API}/tape_ids/{key_date}?collections={collection}"
-                    print(f"api_request is {api_request}")
-                    resp = requests.get(api_request)
-                    these_tape_ids = resp.json()[collection]
-                    print(f"these_tape_ids is {these_tape_ids}")
-                    if not isinstance(these_tape_ids, (list, tuple)):
-                        these_tape_ids = [these_tape_ids]
-                    these_tape_ids = [[collection, x] for x in these_tape_ids]
-                    tape_ids = tape_ids + these_tape_ids
-                else:
-                    raise Exception(f"Failed to get_tape_ids for {coll_dict} on {key_date}")
-            finally:
-                resp.close() if resp is not None else None
+    key_date_colls = [collection for collection, cdict in coll_dict.items() if cdict.get(key_date, None)]
+    coll_tape_ids = {}
+
+    def on_loaded(collection, tape_ids):
+        coll_tape_ids[collection] = tape_ids
+        if on_result is not None:
+            on_result(collection, tape_ids)
+
+    asyncio.run(aload_all(key_date_colls, lambda c: aget_tape_ids(c, key_date), on_loaded, TAPE_IDS_WORKER_MEMORY))
+
+    # Interleave the collections: the first tape of each, in coll_dict order, then the second of each, and so on
     sorted_tape_ids = []
-    while len(tape_ids) > 0:
-        for coll in coll_dict.keys():
-            for iid, id in enumerate(tape_ids):
-                if id[0] == coll:
-                    sorted_tape_ids.append(tape_ids.pop(iid))
-                    break
+    ntapes = max([len(x) for x in coll_tape_ids.values()] + [0])
+    for i in range(ntapes):
+        for collection in key_date_colls:
+            tape_ids = coll_tape_ids[collection]
+            if i < len(tape_ids):
+                sorted_tape_ids.append(tape_ids[i])
     return sorted_tape_ids
 
 
-def get_next_tih(date, valid_dates):
-    valid_tihs = []
+def build_tih_index(coll_dict):
+    # "MM-DD" -> [[date, collection], ...] for every show on that day of the year, sorted by date, in coll_dict order
+    # within a date. Built in memory whenever the collections are loaded, so it always matches them.
+    global TIH_INDEX
+    index = {}
+    for coll, vcs in coll_dict.items():
+        for date in vcs.keys():
+            month_day = date[5:]
+            if month_day in index:
+                index[month_day].append([date, coll])
+            else:
+                index[month_day] = [[date, coll]]
+    for shows in index.values():
+        shows.sort(key=lambda x: x[0])
+    TIH_INDEX = index
+    return index
+
+
+def get_next_tih(date, tih_index=None):
     dt = time.localtime(time.mktime(time.gmtime()) - 6 * 3600)  # Central time
     tih_pattern = f"{dt[1]:02d}-{dt[2]:02d}"
     print(f"getting next today in history. time is {dt}. pattern is {tih_pattern}")
-    for d in valid_dates:
-        if d[5:] == tih_pattern:
-            valid_tihs.append(d)
+    valid_tihs = (TIH_INDEX if tih_index is None else tih_index).get(tih_pattern, [])
     if len(valid_tihs) == 0:  # There are no today in history shows.
         print(f"There are no Today In History shows for {tih_pattern}")
         return date
-    if date >= valid_tihs[-1]:
-        return valid_tihs[0]
-    for d in valid_tihs:
+    for d, _ in valid_tihs:
         if d > date:
             return d
-    return date
+    return valid_tihs[0][0]
 
 
 def select_key_date(key_date, player, coll_dict, state, ntape, key_collection=None, tape_id=None):
@@ -288,7 +336,7 @@ def select_key_date(key_date, player, coll_dict, state, ntape, key_collection=No
     player.stop()
     player.set_playlist([], [])
     # player.reset_player()
-    collection, tracklist, urls, selected_tape_id = select_date(coll_dict, key_date, ntape, key_collection)
+    collection, tracklist, urls, selected_tape_id = select_date(coll_dict, key_date, ntape, key_collection, tape_id)
     vcs = coll_dict[collection][key_date]
     player.set_playlist(tracklist, urls)
     ntape = 0
@@ -308,6 +356,39 @@ def select_key_date(key_date, player, coll_dict, state, ntape, key_collection=No
     return selected_vcs, state
 
 
+def save_position(player, state, force=False):
+    # Checkpoint where we are in the show at most once a minute, and only if it has changed, to save wear on the flash
+    global POSITION_SAVE_TIME, SAVED_POSITION
+    if not force and time.ticks_diff(time.ticks_ms(), POSITION_SAVE_TIME) < POSITION_SAVE_INTERVAL:
+        return
+    POSITION_SAVE_TIME = time.ticks_ms()
+    position = player.position()
+    if position is None:
+        return
+    position = {
+        "selected_date": state["selected_date"],
+        "selected_collection": state["selected_collection"],
+        "selected_tape_id": state["selected_tape_id"],
+        "track": position[0],
+        "offset": position[1],
+        "quality": position[2],
+    }
+    if position == SAVED_POSITION:
+        return
+    SAVED_POSITION = position
+    utils.save_position(position)
+
+
+def load_position(key_date):
+    # Returns the saved position if it is for this date, so that we can pick up the same tape where we left off
+    global SAVED_POSITION
+    position = utils.load_position()
+    if position.get("selected_date", None) != key_date:
+        return {}
+    SAVED_POSITION = position
+    return position
+
+
 def play_pause(player):
     tm.clear_bbox(playpause_bbox)
     if player.is_playing():
@@ -320,30 +401,9 @@ def play_pause(player):
     return
 
 
-@micropython.native
-def get_next_show(key_date, valid_dates, coll_name, coll_dict):
-    coll_names = list(coll_dict.keys())
-    if not (coll_name in coll_names):
-        coll_name = coll_names[0]
+def get_next_show(key_date, show_index, coll_name):
     print(f"getting next show {key_date}, {coll_name}")
-    c_index = coll_names.index(coll_name)
-
-    start_index = 0
-    for i, date in enumerate(valid_dates):
-        if date >= key_date:
-            start_index = i
-            break
-    print(f"start_index {start_index}/{len(valid_dates)-1}")
-    for i, date in enumerate(valid_dates[start_index:] + valid_dates[:start_index]):
-        if (i == 0) and ((c_index + 1) < len(coll_names)):
-            for c in coll_names[c_index + 1 :]:
-                if date in coll_dict[c].keys():
-                    return date, c
-        elif i > 0:
-            for c in coll_names:
-                if date in coll_dict[c].keys():
-                    return date, c
-    return key_date, coll_name
+    return show_index.next_show(key_date, coll_name)
 
 
 def audio_pump(player, Nmax=1, fill_level=0.95):
@@ -367,7 +427,6 @@ def main_loop(player, coll_dict, state):
     key_date = set_date(state["selected_date"])
     collection = state["selected_collection"]
     selected_date = key_date
-    collections = list(coll_dict.keys())
     current_collection = ""
     vcs = ""
     selected_vcs = ""
@@ -380,11 +439,7 @@ def main_loop(player, coll_dict, state):
     resume_playing = -1
     resume_playing_delay = 1000
     ntape = 0
-    valid_dates = set()
-    for c in collections:
-        valid_dates = valid_dates | set(list(coll_dict[c].keys()))
-    del c
-    valid_dates = sorted(list(valid_dates))
+    valid_dates = ShowIndex(coll_dict)
     tm.screen_on_time = time.ticks_ms()
     tm.clear_screen()
     tm.label_soft_knobs("Month", "Day", "Year")
@@ -404,12 +459,26 @@ def main_loop(player, coll_dict, state):
                 print("PlayPause RELEASED")
                 if (player.is_stopped()) and (player.current_track is None):
                     if (key_date in valid_dates) and tm.power():
-                        selected_vcs, state = select_key_date(key_date, player, coll_dict, state, ntape)
+                        position = load_position(key_date)
+                        selected_vcs, state = select_key_date(
+                            key_date,
+                            player,
+                            coll_dict,
+                            state,
+                            ntape,
+                            position.get("selected_collection", None),
+                            position.get("selected_tape_id", None),
+                        )
+                        if position.get("selected_tape_id", None) == state["selected_tape_id"]:
+                            print(f"Resuming track {position['track']} at offset {position['offset']}")
+                            player.seek(position["track"], position["offset"], position.get("quality", 0))
                         selected_date = state["selected_date"]
                         collection = state["selected_collection"]
                         vcs = selected_vcs
                         gc.collect()
                 play_pause(player)
+                if player.is_paused():
+                    save_position(player, state, force=True)
             else:
                 play_pause_press_time = time.ticks_ms()
                 print("PlayPause PRESSED")
@@ -420,7 +489,7 @@ def main_loop(player, coll_dict, state):
                 player.stop()
                 player.current_track = None
                 play_pause_press_time = time.ticks_ms() + 5_000
-                key_date = set_date(utils.deal_n(valid_dates, 1)[0])
+                key_date = set_date(valid_dates.dates[random.randrange(len(valid_dates))])
         if pStop_old != tm.pStop.value():
             pStop_old = tm.pStop.value()
             if pStop_old:
@@ -435,6 +504,9 @@ def main_loop(player, coll_dict, state):
         buffer_fill = audio_pump(player, fill_level=0.3)
         # buffer_fill = player.audio_pump()
 
+        if player.is_playing():
+            save_position(player, state)
+
         if player.is_stopped() and (resume_playing > 0) and (time.ticks_ms() >= resume_playing):
             print("Resuming playing")
             resume_playing = -1
@@ -543,10 +615,12 @@ def main_loop(player, coll_dict, state):
                     month_new = month_old = tm.m._value
                     day_new = day_old = tm.d._value
                     player.pause()
+                    save_position(player, state, force=True)
                     tm.power(0)
                 else:  # power back on.
                     if refresh_meta_needed():
                         coll_dict = get_coll_dict(state["collection_list"])
+                        valid_dates = ShowIndex(coll_dict)
                     tm.power(1)
                 power_press_time = time.ticks_ms()
                 print("Power UP -- screen")
@@ -580,7 +654,7 @@ def main_loop(player, coll_dict, state):
             if pYSw_old:
                 print("Year DOWN")
             else:  # cycle through Today In History (once we know what today is!)
-                key_date = set_date(get_next_tih(key_date, valid_dates))
+                key_date = set_date(get_next_tih(key_date))
                 print("Year UP")
 
         if pMSw_old != tm.pMSw.value():
@@ -596,7 +670,7 @@ def main_loop(player, coll_dict, state):
             if pDSw_old:
                 print("Day UP")
             else:
-                date, collection = get_next_show(key_date, valid_dates, collection, coll_dict)
+                date, collection = get_next_show(key_date, valid_dates, collection)
                 vcs = coll_dict[collection][date]
                 key_date = set_date(date)
                 print(f"vcs {vcs}. collection {collection}. date {date}")
@@ -708,9 +782,20 @@ def get_shows(coll_dict, key_date):
 def choose_tape(coll_dict, key_date):
     print(f"choose_tape: {key_date}")
     tm.clear_screen()
-    tm.write("Select Tape", 0, 0, pfont_small, tm.YELLOW, show_end=-3)
+    tm.write(f"{key_date} Loading tapes", 0, 0, pfont_small, tm.YELLOW, show_end=-3)
     shows = get_shows(coll_dict, key_date)
 
+    # Fetch the tapes of every show on this date at once, listing each collection as it answers
+    nloaded = [0]
+
+    def on_result(collection, tape_ids):
+        nloaded[0] += 1
+        y0 = nloaded[0] * pfont_small.HEIGHT
+        if y0 + pfont_small.HEIGHT <= tm.SCREEN_HEIGHT:
+            tm.write(f"{collection}: {len(tape_ids)}", 0, y0, pfont_small, tm.WHITE, show_end=-3)
+
+    all_tape_ids = get_tape_ids({c: coll_dict[c] for c in shows}, key_date, on_result=on_result)
+
     if len(shows) > 1:
         while not tm.pSelect.value():  # Wait for select button to be released
             time.sleep(0.1)
@@ -720,9 +805,7 @@ def choose_tape(coll_dict, key_date):
     else:
         collection = shows[0]
 
-    tm.clear_screen()
-    tm.write(f"{collection} {key_date} Loading tapes", 0, 0, pfont_small, tm.YELLOW, show_end=-3)
-    tape_ids = get_tape_ids({collection: coll_dict[collection]}, key_date)  # make sure coll_dict not corrupted
+    tape_ids = [x for x in all_tape_ids if x[0] == collection]
     seen = set()
     tape_choices = [short_tape_id(x[1]) for x in tape_ids if x[0] == collection and not (x[1] in seen or seen.add(x[1]))]
     if len(tape_choices) == 1:
@@ -791,28 +874,140 @@ def display_tracks(*track_names):
 
 def add_vcs(coll):
     print(f"Adding vcs for coll {coll}")
+    return asyncio.run(aload_vcs(coll))
+
+
+def load_vcs(coll):
+    data = add_vcs(coll)
+    return data
+
+
+def read_local_vcs(coll):
+    # Returns the version and vcs stored on flash, or None, None
+    path = f"{VCS_DIR}/{coll}.json"
+    if not metadata_store.exists(path):
+        return None, None
+    try:
+        saved = metadata_store.read(path)
+        return saved["version"], saved["vcs"]
+    except Exception as e:
+        print(f"Failed to read {path}. {e}")
+        metadata_store.remove(path)
+        return None, None
+
+
+def write_local_vcs(coll, version, vcs):
+    try:
+        metadata_store.write({"version": version, "vcs": vcs}, f"{VCS_DIR}/{coll}.json")
+    except Exception as e:
+        print(f"Failed to save vcs for {coll}. {e}")
+        metadata_store.remove(f"{VCS_DIR}/{coll}.json")
+
+
+def apply_vcs_delta(vcs, delta):
+    for date in delta.get("removed", []):
+        vcs.pop(date, None)
+    for date, value in delta.get("vcs", {}).items():
+        vcs[date] = value
+    return vcs
+
+
+async def aget_json(url):
+    # None if the file doesn't exist. Other failures raise, so that they aren't taken for a missing file
+    resp = await async_urequests.get(url)
+    if resp.status_code == 404:
+        return None
+    if resp.status_code != 200:
+        raise OSError(f"status {resp.status_code}")
+    return resp.json()
+
+
+async def aload_vcs(coll):
+    # The cloud keeps a version number for each collection's vcs, in vcs/<coll>/version.json, and the changes since each
+    # recent version in vcs/<coll>/since/<version>.json (see make_vcs_deltas.py). Once we have a copy on flash, we only
+    # fetch the changes since its version. We fall back to the full vcs if there is no delta file for our version.
+    version, vcs = read_local_vcs(coll)
+    if version is not None:
+        delta_url = f"{CLOUD_PATH}/vcs/{coll}/since/{version}.json"
+        try:
+            delta = await aget_json(delta_url)
+        except Exception as e:
+            print(f"Failed to get {delta_url}. {e}. Using stored vcs")
+            return vcs
+        if delta is not None:
+            if delta["version"] != version:
+                print(f"Updating vcs for {coll} from version {version} to {delta['version']}")
+                apply_vcs_delta(vcs, delta)
+                write_local_vcs(coll, delta["version"], vcs)
+            return vcs
+        print(f"No vcs delta for {coll} since version {version}")
+        vcs = None
+        gc.collect()
+
+    # Get the version before the vcs, so that we never store a vcs with a newer version than it has
     vcs_url = f"{CLOUD_PATH}/vcs/{coll}_vcs.json"
-    print(vcs_url)
-    resp = None
     try:
-        resp = requests.get(vcs_url)
-        if resp.status_code == 200:
-            vcs = resp.json()
-        else:
+        latest = await aget_json(f"{CLOUD_PATH}/vcs/{coll}/version.json")
+        version = latest["version"] if latest else None
+    except Exception as e:
+        print(f"Failed to get vcs version for {coll}. {e}")
+        version = None
+
+    async def from_cloud():
+        print(vcs_url)
+        resp = await http_cache.aget(vcs_url)
+        if resp.status_code != 200:
             print(f"status was {resp.status_code}")
-            api_request = f"{API}/vcs/{coll}"
-            print(f"API request is {api_request}")
-            resp = requests.get(api_request)
-            vcs = resp.json()[coll]
-    finally:
-        if resp is not None:
-            resp.close()
+            return None
+        return resp.json()
+
+    async def from_api():
+        api_request = f"{API}/vcs/{coll}"
+        print(f"API request is {api_request}")
+        resp = await async_urequests.get(api_request)
+        return resp.json()[coll] if resp.status_code == 200 else None
+
+    # Not hedged. The vcs bodies are large, and a second download in parallel would double the bandwidth and the heap
+    try:
+        vcs = await from_cloud()
+    except Exception as e:
+        print(f"Failed to get {vcs_url}. {e}")
+        vcs = None
+    if vcs is None:
+        gc.collect()
+        vcs = await from_api()
+    if vcs is None:
+        raise Exception(f"Failed to load vcs for {coll}")
+    if version is not None:
+        write_local_vcs(coll, version, vcs)
+        http_cache.remove(vcs_url)  # The copy in VCS_DIR replaces it
     return vcs
 
 
-def load_vcs(coll):
-    data = add_vcs(coll)
-    return data
+async def aload_all(keys, load, on_loaded, worker_memory):
+    # Run the coroutine load(key) for several keys at once. Each worker takes the next key when it finishes one, and the
+    # number of workers depends on the free heap. on_loaded(key, result) is called as each one finishes, in the order they arrive.
+    gc.collect()
+    n_workers = max(1, min(MAX_WORKERS, len(keys), gc.mem_free() // worker_memory))
+    print(f"Loading {len(keys)} items with {n_workers} workers")
+    todo = list(keys)
+    errors = []
+
+    async def worker():
+        while todo and not errors:
+            key = todo.pop(0)
+            try:
+                result = await load(key)
+            except Exception as e:
+                errors.append(e)
+                return
+            on_loaded(key, result)
+            result = None
+            gc.collect()
+
+    await asyncio.gather(*[worker() for _ in range(n_workers)])
+    if errors:
+        raise errors[0]
 
 
 def lookup_date(d, col_d):
@@ -870,19 +1065,24 @@ def get_collection_names_dict():
 
 def get_coll_dict(collection_list):
     global COLLS_LOADED_TIME
+    loaded = {}
+
+    def on_loaded(coll, vcs):
+        loaded[coll] = vcs
+        if len(vcs) == 0:
+            print(f"Collection {coll} is empty. No shows added")
+            return
+        coll_dates = vcs.keys()
+        tm.y._min_val = min(int(min(coll_dates)[:4]), tm.y._min_val)
+        tm.y._max_val = max(int(max(coll_dates)[:4]), tm.y._max_val)
+
+    asyncio.run(aload_all(collection_list, aload_vcs, on_loaded, VCS_WORKER_MEMORY))
+
+    # Keep the order of the collection list, whatever order they arrived in
     coll_dict = OrderedDict({})
-    min_year = tm.y._min_val
-    max_year = tm.y._max_val
     for coll in collection_list:
-        coll_dict[coll] = load_vcs(coll)
-        if len(coll_dict[coll]) == 0:
-            print(f"Collection {coll} is empty. No shows added")
-            continue
-        coll_dates = coll_dict[coll].keys()
-        min_year = min(int(min(coll_dates)[:4]), min_year)
-        max_year = max(int(max(coll_dates)[:4]), max_year)
-        tm.y._min_val = min_year
-        tm.y._max_val = max_year
+        coll_dict[coll] = loaded[coll]
+    build_tih_index(coll_dict)
     COLLS_LOADED_TIME = time.ticks_ms()
     return coll_dict
 
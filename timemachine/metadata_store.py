@@ -0,0 +1,161 @@
+"""
+litestream
+Copyright (C) 2026  spertilo.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# JSON metadata on flash, stored gzipped. Callers keep using the names they always have, e.g.
+# /metadata/78rpm/1920_1930_tracklist.json, and the file on flash is /metadata/78rpm/1920_1930_tracklist.json.gz.
+# Plain files written before are still read, and are replaced the next time they are written.
+# Reading decompresses as it goes, and with paths/on_value only the parts named are built (see json_stream).
+#
+# If the firmware can't compress, we write plain json instead. stats() shows how much space compression has saved.
+
+import deflate
+import io
+import json
+import os
+
+import json_stream
+import utils
+
+COMPRESS = None  # None until can_compress() has tried
+GZ = ".gz"
+CHUNK_SIZE = 1024
+DEBUG = False
+
+_stats = {"files": 0, "json_bytes": 0, "stored_bytes": 0}
+
+
+class _CountingWriter(io.IOBase):
+    # Counts the json bytes on their way to the compressor
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        return self.stream.write(data)
+
+
+def stored_path(path):
+    # The file on flash for path, or None
+    if utils.path_exists(path + GZ):
+        return path + GZ
+    if utils.path_exists(path):
+        return path
+    return None
+
+
+def exists(path):
+    return stored_path(path) is not None
+
+
+def remove(path):
+    utils.remove_file(path + GZ)
+    utils.remove_file(path)
+
+
+def _record(json_bytes, stored):
+    _stats["files"] += 1
+    _stats["json_bytes"] += json_bytes
+    _stats["stored_bytes"] += os.stat(stored)[6]
+    DEBUG and print(f"metadata_store: {stored} {json_bytes} -> {os.stat(stored)[6]} bytes")
+
+
+def can_compress():
+    # The firmware may be built without compression. Try it once on a few bytes
+    global COMPRESS
+    if COMPRESS is None:
+        try:
+            with deflate.DeflateIO(io.BytesIO(), deflate.GZIP) as z:
+                z.write(b"{}")
+            COMPRESS = True
+        except Exception as e:
+            print(f"metadata_store: can't compress. Writing plain json. {e}")
+            COMPRESS = False
+    return COMPRESS
+
+
+def _write_compressed(path, dump):
+    # dump(stream) writes the json. Returns the path written, or None if we can't compress
+    if not can_compress():
+        return None
+    try:
+        with open(path + GZ, "wb") as f:
+            with deflate.DeflateIO(f, deflate.GZIP) as z:
+                counter = _CountingWriter(z)
+                dump(counter)
+    except Exception as e:
+        utils.remove_file(path + GZ)
+        raise e
+    utils.remove_file(path)
+    _record(counter.count, path + GZ)
+    return path + GZ
+
+
+def write(obj, path):
+    utils.mkdirs(utils.dirname(path))
+    if _write_compressed(path, lambda stream: json.dump(obj, stream)) is None:
+        utils.write_json(obj, path)
+        _record(os.stat(path)[6], path)
+
+
+def _copy(readinto, stream):
+    buf = bytearray(CHUNK_SIZE)
+    mv = memoryview(buf)
+    while True:
+        n = readinto(buf)
+        if not n:
+            break
+        stream.write(mv[:n])
+
+
+def save_response(resp, path):
+    # Write the body of an mrequests Response to flash, compressing it as it arrives
+    utils.mkdirs(utils.dirname(path))
+    try:
+        if resp.content_encoding == b"gzip":
+            # It is gzipped already. Store it as it came. We don't know how big the json is, so it isn't in the stats
+            try:
+                with open(path + GZ, "wb") as f:
+                    _copy(resp.readinto_raw, f)
+            except Exception as e:
+                utils.remove_file(path + GZ)
+                raise e
+            utils.remove_file(path)
+        elif _write_compressed(path, lambda stream: _copy(resp.readinto, stream)) is None:
+            resp.save(path)
+            _record(os.stat(path)[6], path)
+    finally:
+        resp.close()
+
+
+def read(path, paths=None, on_value=None):
+    stored = stored_path(path)
+    if stored is None:
+        raise OSError(f"{path} not found")
+    with open(stored, "rb") as f:
+        stream = deflate.DeflateIO(f, deflate.GZIP) if stored.endswith(GZ) else f
+        if paths is None and on_value is None:
+            return json.load(stream)
+        return json_stream.load(stream, paths, on_value, CHUNK_SIZE)
+
+
+def stats():
+    result = dict(_stats)
+    result["saved_bytes"] = _stats["json_bytes"] - _stats["stored_bytes"]
+    result["ratio"] = _stats["stored_bytes"] / _stats["json_bytes"] if _stats["json_bytes"] else 1.0
+    return result
@@ -7,6 +7,17 @@ try:
 except ImportError:
     import usocket as socket
 
+try:
+    import io
+    import deflate
+except ImportError:
+    deflate = None
+
+try:
+    import ssl_context
+except ImportError:
+    ssl_context = None
+
 
 MICROPY = sys.implementation.name == "micropython"
 MAX_READ_SIZE = 4 * 1024
@@ -135,20 +146,69 @@ class Response:
         self._cached = None
         self._chunk_size = 0
         self._content_size = 0
+        self._raw_read = 0
+        self._decoder = None
+        self._rbuf = None
+        self._rpos = 0
+        self._rend = 0
         self.chunked = False
+        self.content_encoding = None
         self.status_code = None
         self.reason = ""
         self.headers = [] if save_headers else None
 
-    def read(self, size=MAX_READ_SIZE):
-        sf = self.sf
+    @property
+    def compressed(self):
+        return deflate is not None and self.content_encoding in (b"gzip", b"deflate")
 
+    def read(self, size=MAX_READ_SIZE):
+        if size:
+            buf = bytearray(size)
+            n = self.readinto(buf)
+            return bytes(memoryview(buf)[:n]) if n < size else bytes(buf)
+
+        # Read everything. The decoded length of a compressed or chunked body is unknown
+        if not (self.chunked or self.compressed) and self._content_size:
+            buf = bytearray(self._content_size - self._raw_read)
+            mv = memoryview(buf)
+            pos = 0
+            while pos < len(buf):
+                n = self.readinto(mv[pos:])
+                if not n:
+                    break
+                pos += n
+            return bytes(mv[:pos]) if pos < len(buf) else bytes(buf)
+
+        data = []
+        while True:
+            chunk = self.read(MAX_READ_SIZE)
+            if not chunk:
+                break
+            data.append(chunk)
+        return b"".join(data)
+
+    def readinto(self, buf):
+        # Fill buf with as much of the body as is available, and return the number of bytes. 0 at the end of the body
+        if not self.compressed:
+            return self._readinto_raw(memoryview(buf))
+
+        # The body is decoded as it is read, after any chunked transfer encoding is removed
+        if self._decoder is None:
+            self._decoder = deflate.DeflateIO(_RawStream(self), deflate.AUTO)
+        return self._decoder.readinto(buf)
+
+    def readinto_raw(self, buf):
+        # The body as it was sent: without the transfer encoding, but still compressed if it was
+        return self._readinto_raw(memoryview(buf))
+
+    def _readinto_raw(self, mv):
+        # The body without the transfer encoding
         if self.chunked:
             if self._chunk_size == 0:
-                l = sf.readline().strip()
+                l = self._readline().strip()
 
                 if not l:
-                    return b''
+                    return 0
 
                 # ignore chunk extensions
                 l = l.split(b";", 1)[0]
@@ -156,48 +216,99 @@ class Response:
 
                 if self._chunk_size == 0:
                     # End of message
-                    sep = sf.read(2)
+                    sep = self._read_exactly(2)
                     if sep != b"\r\n":
                         raise ValueError("Expected final chunk separator, read %r instead." % sep)
 
-                    return b""
+                    return 0
 
-            data = sf.read(min(size or MAX_READ_SIZE, self._chunk_size))
-            self._chunk_size -= max(0, len(data))
+            n = self._buffered_readinto(mv[: min(len(mv), self._chunk_size)])
+            self._chunk_size -= n
 
             if self._chunk_size == 0:
-                sep = sf.read(2)
+                sep = self._read_exactly(2)
                 if sep != b"\r\n":
                     raise ValueError("Expected chunk separator, read %r instead." % sep)
 
-            return data
+            return n
         else:
-            if size:
-                return sf.read(size)
-            else:
-                return sf.read(self._content_size)
-
-    def save(self, fn, chunk_size=1024):
-        read = 0
+            if self._content_size:
+                remain = self._content_size - self._raw_read
+                if remain <= 0:
+                    return 0
+                mv = mv[: min(len(mv), remain)]
+            n = self._buffered_readinto(mv)
+            self._raw_read += n
+            return n
+
+    # The chunk sizes and separators are read from a read-ahead buffer rather than with small reads from the socket.
+    # It is allocated once per response.
+
+    def _fill(self):
+        if self._rbuf is None:
+            self._rbuf = bytearray(MAX_READ_SIZE)
+        self._rpos = 0
+        self._rend = self._sock_readinto(self._rbuf) or 0
+        return self._rend > 0
+
+    def _sock_readinto(self, mv):
+        readinto = getattr(self.sf, "readinto1", None) or self.sf.readinto
+        return readinto(mv)
+
+    def _buffered_readinto(self, mv):
+        if self._rpos < self._rend:
+            n = min(len(mv), self._rend - self._rpos)
+            mv[:n] = memoryview(self._rbuf)[self._rpos : self._rpos + n]
+            self._rpos += n
+            return n
+
+        if len(mv) >= MAX_READ_SIZE:
+            # Big reads go straight into the caller's buffer
+            return self._sock_readinto(mv) or 0
+
+        if not self._fill():
+            return 0
+        return self._buffered_readinto(mv)
+
+    def _readline(self):
+        line = b""
+        while True:
+            if self._rpos == self._rend and not self._fill():
+                return line
+            buf = self._rbuf
+            start = i = self._rpos
+            while i < self._rend and buf[i] != 10:
+                i += 1
+            if i < self._rend:
+                i += 1
+                self._rpos = i
+                return line + bytes(buf[start:i])
+            line += bytes(buf[start:i])
+            self._rpos = i
+
+    def _read_exactly(self, n):
+        data = b""
+        while len(data) < n:
+            if self._rpos == self._rend and not self._fill():
+                break
+            take = min(n - len(data), self._rend - self._rpos)
+            data += bytes(self._rbuf[self._rpos : self._rpos + take])
+            self._rpos += take
+        return data
+
+    def save(self, fn, chunk_size=MAX_READ_SIZE):
+        # One buffer for the whole download
+        buf = bytearray(chunk_size)
+        mv = memoryview(buf)
 
         with open(fn, "wb") as fp:
             while True:
-                if self.chunked:
-                    chunk = self.read()
-                else:
-                    remain = self._content_size - read
-
-                    if remain <= 0:
-                        break
-
-                    chunk = self.read(min(chunk_size, remain))
-
-                read += len(chunk)
+                n = self.readinto(buf)
 
-                if not chunk:
+                if not n:
                     break
 
-                fp.write(chunk)
+                fp.write(mv[:n])
 
         self.close()
 
@@ -208,6 +319,8 @@ class Response:
         elif data[:15].lower() == b"content-length:":
             self._content_size = int(data.split(b":", 1)[1])
             # print("Content length: %i" % self._content_size)
+        elif data[:17].lower() == b"content-encoding:":
+            self.content_encoding = data[17:].strip().lower()
 
     # overwrite this method, if you want to process/store headers differently
     def add_header(self, data):
@@ -223,6 +336,8 @@ class Response:
         if self.sock:
             self.sock.close()
             self.sock = None
+        self._decoder = None
+        self._rbuf = None
         self._cached = None
 
     @property
@@ -245,6 +360,17 @@ class Response:
         return ujson.loads(self.content)
 
 
+if deflate is not None:
+
+    class _RawStream(io.IOBase):
+        # Lets DeflateIO read the body of a response, with the transfer encoding already removed
+        def __init__(self, resp):
+            self.resp = resp
+
+        def readinto(self, buf):
+            return self.resp._readinto_raw(memoryview(buf))
+
+
 def request(
     method,
     url,
@@ -257,6 +383,7 @@ def request(
     save_headers=False,
     max_redirects=1,
     timeout=None,
+    decompress=True,
 ):
     if auth:
         headers.update(auth if callable(auth) else encode_basic_auth(auth[0], auth[1]))
@@ -285,7 +412,10 @@ def request(
         try:
             # print("Connecting to %s:%i..." % (ctx.host, ctx.port))
             sock.connect(ai[-1])
-            if ctx.scheme == "https":
+            if ctx.scheme == "https" and ssl_context is not None:
+                # Shares the context, and the TLS sessions, with the other connections to this host
+                sock = ssl_context.wrap_socket(sock, ctx.host)
+            elif ctx.scheme == "https":
                 try:
                     import ssl
                 except ImportError:
@@ -304,6 +434,12 @@ def request(
             if not b"Host" in headers:
                 sf.write(b"Host: %s\r\n" % ctx.host.encode())
 
+            # Ask for a compressed body if we can decode it. Not for range requests, where the offsets refer to the encoded body.
+            if decompress and deflate is not None:
+                names = [(k if isinstance(k, bytes) else k.encode()).lower() for k in headers]
+                if not b"accept-encoding" in names and not b"range" in names:
+                    sf.write(b"Accept-Encoding: gzip, deflate\r\n")
+
             for k, val in headers.items():
                 sf.write(k if isinstance(k, bytes) else k.encode('ascii'))
                 sf.write(b": ")
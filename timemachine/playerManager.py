@@ -23,14 +23,16 @@ async def dummy():
 
 
 class PlayerManager:
-    def __init__(self, callbacks, debug=0):
+    def __init__(self, callbacks, debug=0, threaded_decode=False):
         self.callbacks = callbacks
         self.DEBUG = debug
         self.init_vars()
         if "display" not in self.callbacks.keys():
             self.callbacks["display"] = lambda *x: print(f"PlayerManager display: {x}")
 
-        self.player = audioPlayer.AudioPlayer(callbacks={"messages": self.messenger}, debug=debug)
+        self.player = audioPlayer.AudioPlayer(
+            callbacks={"messages": self.messenger}, debug=debug, threaded_decode=threaded_decode
+        )
         self.DEBUG = debug
 
     def init_vars(self):
@@ -148,6 +150,7 @@ class PlayerManager:
             self.display(*self.tracklist)
             return
 
+        # The player couldn't carry on reading the chunk where it left off, so start again from the beginning of the chunk
         if "long pause" in message:
             self.stop(reset_tracklist=False)
             chunks_to_send = []
@@ -189,6 +192,9 @@ class PlayerManager:
         return
 
     def play(self):
+        # A paused player still has its buffers, even if there is nothing left in the playlist
+        if self.player.is_paused():
+            return self.player.play()
         if len(self.player.playlist) == 0:
             print("No tracks in playlist")
             return
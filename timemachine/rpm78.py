@@ -20,11 +20,8 @@ import gc
 import re
 import sys
 import time
-
-try:
-    from async_urequests import urequests as requests
-except ImportError:
-    from mrequests import mrequests as requests
+import uasyncio as asyncio
+from collections import OrderedDict
 
 # import micropython # Use micropython.mem_info() to see memory available.
 import fonts.DejaVu_33 as large_font
@@ -32,8 +29,10 @@ import fonts.NotoSans_18 as pfont_small
 import fonts.NotoSans_24 as pfont_med
 import fonts.NotoSans_32 as pfont_large
 
+import async_urequests
 import board as tm
 import utils
+from cache_manager import disk_cache
 
 import archive_utils
 import audioPlayer
@@ -46,6 +45,9 @@ API = "https://gratefuldeadtimemachine.com"  # google cloud version mapped to he
 AUTO_PLAY = True
 DATE_SET_TIME = time.ticks_ms()
 CONFIG_CHOICES = []
+M3U_WORKERS = 3  # m3u files are small, so this is limited by the TLS buffers
+TAPE_METADATA_CACHE = OrderedDict()  # identifier -> (urls, tracklist, artists)
+TAPE_METADATA_CACHE_SIZE = 60
 
 stage_date_bbox = tm.Bbox(0, 0, tm.SCREEN_WIDTH, 27)
 playpause_bbox = tm.Bbox(145, 0, tm.SCREEN_WIDTH, 27)
@@ -88,28 +90,27 @@ def select_date_range(date_range, N_to_select=60):
     )
     metadata_cache = f"/metadata/78rpm/{date_range[0]}_{date_range[1]}_tracklist.json"
     metadata_track_index = f"/metadata/78rpm/{date_range[0]}_{date_range[1]}_tracknum.json"
-    if utils.path_exists(metadata_cache):
+    coll_dict = disk_cache.get("rpm78", metadata_cache)
+    if coll_dict is not None:
         try:
             track_index = utils.read_json(metadata_track_index)
-            coll_dict = utils.read_json(metadata_cache)
             tracks_remaining = len(coll_dict["identifier"]) - track_index
             if tracks_remaining < 7:
                 print(f"Only {tracks_remaining} remaining. Deleting")
-                utils.remove_file(metadata_cache)
+                disk_cache.remove(metadata_cache)
                 utils.remove_file(metadata_track_index)
-                track_index = 0
+                coll_dict = None
         except Exception as e:
-            utils.remove_file(metadata_cache)
-    if not utils.path_exists(metadata_cache):
+            disk_cache.remove(metadata_cache)
+            coll_dict = None
+    if coll_dict is None:
         track_index = 0
         coll_dict = archive_utils.subset_collection(
             ["identifier", "date"], "georgeblood", date_range, N_to_select, prefix="78_"
         )
         indices = utils.shuffle(list(range(len(coll_dict[list(coll_dict.keys())[0]]))))
         coll_dict = {k: [v[i] for i in indices] for k, v in coll_dict.items()}
-        while utils.disk_free() < 100:
-            utils.remove_oldest_files("/metadata/rpm78", 1)
-        utils.write_json(coll_dict, metadata_cache)
+        disk_cache.put("rpm78", metadata_cache, coll_dict)
         utils.write_json(0, metadata_track_index)
     coll_dict = {k: v[track_index:] for k, v in coll_dict.items()}
     tape_ids = coll_dict["identifier"]
@@ -118,51 +119,115 @@ def select_date_range(date_range, N_to_select=60):
     return tape_ids, tape_dates, track_index
 
 
-def get_urls_for_ids(tape_ids):
+def get_urls_for_ids(tape_ids, on_ready=None, pump=None):
+    # Fetch the m3u of several records at once. on_ready(urls, tracklist, artists) is called for each record as soon as
+    # it and all the records before it have arrived, so that the playlist is always in the order of tape_ids.
+    # pump() is called while we wait, to keep the audio going.
     urls = []
     tracklist = []
     artists = []
     tm.clear_bbox(bottom_bbox)
     tm.clear_bbox(playpause_bbox)
     tm.write("Choosing Songs", bottom_bbox.x0, bottom_bbox.y0, pfont_small, tm.PURPLE, show_end=1)
-    for identifier in tape_ids:
-        print(f"Getting metadata for {identifier}")
-        u, t, a = get_tape_metadata(identifier)
-        _ = [urls.append(x) for x in u]
-        _ = [tracklist.append(x) for x in t]
-        _ = [artists.append(x) for x in a]
+
+    def add_record(u, t, a):
+        urls.extend(u)
+        tracklist.extend(t)
+        artists.extend(a)
+        if on_ready is not None:
+            on_ready(u, t, a)
+
+    asyncio.run(afetch_tape_metadata(tape_ids, add_record, pump))
     return urls, tracklist, artists
 
 
-@micropython.native
-def get_tape_metadata(identifier):
-    tracklist = []
-    urls = []
-    artists = []
-    url_m3u = f"https://archive.org/download/{identifier}/{identifier}_vbr.m3u"
+async def afetch_tape_metadata(tape_ids, on_ready, pump=None):
+    results = [None] * len(tape_ids)
+    todo = list(range(len(tape_ids)))
+    n_ready = 0
+    n_running = 0
+
+    async def worker():
+        nonlocal n_ready, n_running
+        n_running += 1
+        while todo:
+            i = todo.pop(0)
+            results[i] = await aget_tape_metadata(tape_ids[i])
+            while n_ready < len(results) and results[n_ready] is not None:
+                on_ready(*results[n_ready])
+                results[n_ready] = ()  # Done with it, but not None
+                n_ready += 1
+        n_running -= 1
+
+    async def pumper():
+        await asyncio.sleep_ms(0)  # Let the workers start
+        while n_running > 0:
+            pump()
+            await asyncio.sleep_ms(10)
+
+    workers = [worker() for _ in range(min(M3U_WORKERS, len(tape_ids)))]
+    if pump is not None:
+        workers.append(pumper())
+    await asyncio.gather(*workers)
+
+
+async def aget_tape_metadata(identifier):
+    if identifier in TAPE_METADATA_CACHE:
+        return TAPE_METADATA_CACHE[identifier]
+    print(f"Getting metadata for {identifier}")
+    url_m3u = f"{archive_utils.ARCHIVE_URL}/download/{identifier}/{identifier}_vbr.m3u"
     try:
-        resp = requests.get(url_m3u)
+        resp = await async_urequests.get(url_m3u)
         if resp.status_code != 200:
             print(f"Error in request from {url_m3u}. Status code {resp.status_code}")
             raise Exception("Download Error")
-        text = resp.text.split("\n")
-        urls = [x for x in text if len(x) > 0]
-        fields = [x.split("/")[-2:] for x in urls]
-        track_artist = [x[-1].split("-") for x in fields]
-        tracklist = ["".join(x[:-1]).strip() for x in track_artist]
-        tracklist = [x for x in tracklist if not x.startswith("_78")]
-        tracklist = [re.sub(r"^\d*", "", re.sub(r"\(\d\)", "", x)).strip() for x in tracklist]
-        artists = ["".join(x[-1:]).strip().replace(".mp3", "") for x in track_artist[: len(tracklist)]]
-        urls = urls[: len(tracklist)]
+        result = parse_m3u(resp.text)
     except Exception as e:
         print(f"Exception: {e}. Continuing")
-        urls = tracklist = artists = []
-    finally:
-        if resp is not None:
-            resp.close()
+        return [], [], []
+
+    TAPE_METADATA_CACHE[identifier] = result
+    if len(TAPE_METADATA_CACHE) > TAPE_METADATA_CACHE_SIZE:
+        TAPE_METADATA_CACHE.pop(next(iter(TAPE_METADATA_CACHE)))
+    return result
+
+
+@micropython.native
+def parse_m3u(text):
+    text = text.split("\n")
+    urls = [x for x in text if len(x) > 0]
+    fields = [x.split("/")[-2:] for x in urls]
+    track_artist = [x[-1].split("-") for x in fields]
+    tracklist = ["".join(x[:-1]).strip() for x in track_artist]
+    tracklist = [x for x in tracklist if not x.startswith("_78")]
+    tracklist = [re.sub(r"^\d*", "", re.sub(r"\(\d\)", "", x)).strip() for x in tracklist]
+    artists = ["".join(x[-1:]).strip().replace(".mp3", "") for x in track_artist[: len(tracklist)]]
+    urls = urls[: len(tracklist)]
     return urls, tracklist, artists
 
 
+def load_playlist(player, tape_ids):
+    # Start playing as soon as the first record arrives, and add the rest to the playlist as they come in
+    started = False
+
+    def on_ready(urls, tracklist, artists):
+        nonlocal started
+        if len(urls) == 0:
+            return
+        if not started:
+            player.set_playlist(tracklist, urls)
+            display_tracks(*player.track_names())
+            play_pause(player)
+            started = True
+        else:
+            player.extend_playlist(tracklist, urls)
+
+    get_urls_for_ids(tape_ids, on_ready, player.audio_pump)
+    if not started:
+        player.set_playlist([], [])
+        display_tracks(*player.track_names())
+
+
 def play_pause(player):
     if player.is_playing():
         player.pause()
@@ -225,14 +290,13 @@ def main_loop(player, state):
                     tm.clear_bbox(playpause_bbox)
                     tape_ids, tape_dates, track_index = select_date_range(staged_date_range, tracks_length)
                     date_range = set_date_range(staged_date_range, state)
-                    urls, tracklist, artists = get_urls_for_ids(tape_ids[:5])
                     dates = tape_dates[:5]
-                    player.set_playlist(tracklist, urls)
-                    display_tracks(*player.track_names())
+                    load_playlist(player, tape_ids[:5])
                     tape_ids = tape_ids[5:]
                     tape_dates = tape_dates[5:]
                     gc.collect()
-                play_pause(player)
+                else:
+                    play_pause(player)
 
         if pStop_old != tm.pStop.value():
             pStop_old = tm.pStop.value()
@@ -294,14 +358,11 @@ def main_loop(player, state):
                 tm.clear_bbox(playpause_bbox)
                 tape_ids, tape_dates, track_index = select_date_range(staged_date_range, tracks_length)
                 date_range = set_date_range(staged_date_range, state)
-                urls, tracklist, artists = get_urls_for_ids(tape_ids[:5])
                 dates = tape_dates[:5]
-                player.set_playlist(tracklist, urls)
-                display_tracks(*player.track_names())
+                load_playlist(player, tape_ids[:5])
                 tape_ids = tape_ids[5:]
                 tape_dates = tape_dates[5:]
                 gc.collect()
-                play_pause(player)
             else:
                 select_press_time = time.ticks_ms()
                 print("Select DOWN")
@@ -311,13 +372,10 @@ def main_loop(player, state):
             if pts["current_track"] == 0:
                 tm.clear_bbox(bottom_bbox)
                 tm.write("Flipping Record", bottom_bbox.x0, bottom_bbox.y0, pfont_small, tm.PURPLE)
-                urls, tracklist, artists = get_urls_for_ids(tape_ids[:5])
                 dates = tape_dates[:5]
-                player.set_playlist(tracklist, urls)
-                display_tracks(*player.track_names())
+                load_playlist(player, tape_ids[:5])
                 tape_ids = tape_ids[5:]
                 tape_dates = tape_dates[5:]
-                play_pause(player)
 
         if not tm.pSelect.value():  # long press Select
             if (time.ticks_ms() - select_press_time) > 1_000:
@@ -0,0 +1,107 @@
+"""
+litestream
+Copyright (C) 2026  spertilo.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Every date with a show in the loaded collections, for stepping from show to show with the knobs.
+
+try:
+    import micropython
+except ImportError:  # CPython, for the tests
+
+    class micropython:
+        native = staticmethod(lambda f: f)
+
+
+class ShowIndex:
+    # Every date with a show in any collection, sorted, and a bitmask of the collections that have it
+    # (bit i for the i-th collection of coll_dict). Looking up and stepping through the dates allocates nothing.
+    def __init__(self, coll_dict):
+        self.colls = list(coll_dict.keys())
+        masks = {}
+        for i, vcs in enumerate(coll_dict.values()):
+            bit = 1 << i
+            for date in vcs.keys():
+                masks[date] = masks.get(date, 0) | bit
+        self.dates = sorted(masks.keys())
+        self.masks = [masks[date] for date in self.dates]
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __contains__(self, date):
+        i = self.bisect(date)
+        return (i < len(self.dates)) and (self.dates[i] == date)
+
+    def bisect(self, date):
+        # The index of the first date >= date
+        lo = 0
+        hi = len(self.dates)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.dates[mid] < date:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def coll_index(self, coll_name):
+        return self.colls.index(coll_name) if coll_name in self.colls else 0
+
+    @micropython.native
+    def next_show(self, key_date, coll_name):
+        # The next collection with a show on the first date >= key_date, then the first collection on each later date,
+        # wrapping around to the start
+        n = len(self.dates)
+        if n == 0:
+            return key_date, coll_name
+        c_index = self.coll_index(coll_name)
+        start = self.bisect(key_date)
+        if start == n:
+            start = 0
+        for j in range(n):
+            mask = self.masks[(start + j) % n]
+            if (j == 0) and (self.dates[start] == key_date):
+                mask &= ~((2 << c_index) - 1)  # The collections after this one
+            if mask:
+                k = 0
+                while not (mask >> k) & 1:
+                    k += 1
+                return self.dates[(start + j) % n], self.colls[k]
+        return key_date, coll_name
+
+    @micropython.native
+    def prev_show(self, key_date, coll_name):
+        # The reverse: the previous collection with a show on the last date <= key_date, then the last collection on
+        # each earlier date, wrapping around to the end
+        n = len(self.dates)
+        if n == 0:
+            return key_date, coll_name
+        c_index = self.coll_index(coll_name)
+        start = self.bisect(key_date)
+        on_date = (start < n) and (self.dates[start] == key_date)
+        if not on_date:
+            start = (start - 1) % n
+        for j in range(n):
+            mask = self.masks[(start - j) % n]
+            if (j == 0) and on_date:
+                mask &= (1 << c_index) - 1  # The collections before this one
+            if mask:
+                k = len(self.colls) - 1
+                while not (mask >> k) & 1:
+                    k -= 1
+                return self.dates[(start - j) % n], self.colls[k]
+        return key_date, coll_name
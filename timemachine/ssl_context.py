@@ -0,0 +1,115 @@
+"""
+litestream
+Copyright (C) 2026  spertilo.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# One SSLContext shared by every HTTPS connection (the audio players, mrequests and async_urequests), instead of a new
+# one per socket. If the ssl module supports sessions we keep the last one for each host, and offer it on the next
+# connection so that the server can resume it rather than do a full handshake.
+#
+# Session support is detected at run time. The firmware's ssl module may not have it, in which case we still save the
+# context set up, and the stats show how long the handshakes take.
+#
+#   sock = ssl_context.wrap_socket(conn, host, do_handshake_on_connect=False)
+#   ... write the request. Once that is done, the handshake is done
+#   ssl_context.handshake_done(sock)
+
+import time
+
+try:
+    import ssl
+except ImportError:
+    import ussl as ssl
+
+MAX_PENDING = 16
+_context = None
+_sessions = {}  # host -> the last session
+_pending = {}  # id(sock) -> (host, start time, resuming)
+sessions_supported = None  # None until we have tried
+_stats = {"full": 0, "full_ms": 0, "resumed": 0, "resumed_ms": 0}
+
+
+def context():
+    global _context
+    if _context is None:
+        _context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    return _context
+
+
+def wrap_socket(sock, host, do_handshake_on_connect=True):
+    global sessions_supported
+    start = time.ticks_ms()
+    session = _sessions.get(host) if sessions_supported is not False else None
+    ssock = None
+    if session is not None:
+        try:
+            ssock = context().wrap_socket(
+                sock, server_hostname=host, do_handshake_on_connect=do_handshake_on_connect, session=session
+            )
+        except TypeError:
+            sessions_supported = False
+            _sessions.clear()
+    if ssock is None:
+        ssock = context().wrap_socket(sock, server_hostname=host, do_handshake_on_connect=do_handshake_on_connect)
+
+    if len(_pending) > MAX_PENDING:
+        _pending.clear()  # Connections that failed before handshake_done()
+    _pending[id(ssock)] = (host, start, session is not None)
+    if do_handshake_on_connect:
+        handshake_done(ssock)
+    return ssock
+
+
+def handshake_done(ssock):
+    # Call once the handshake has finished, e.g. after the first write on a non-blocking socket
+    global sessions_supported
+    pending = _pending.pop(id(ssock), None)
+    if pending is None:
+        return
+    host, start, offered = pending
+    elapsed = time.ticks_diff(time.ticks_ms(), start)
+    if offered and getattr(ssock, "session_reused", False):
+        _stats["resumed"] += 1
+        _stats["resumed_ms"] += elapsed
+    else:
+        _stats["full"] += 1
+        _stats["full_ms"] += elapsed
+
+    session = getattr(ssock, "session", None)
+    if session is not None:
+        sessions_supported = True
+        _sessions[host] = session
+    elif sessions_supported is None:
+        sessions_supported = False
+
+
+def forget(host=None):
+    # Drop the saved sessions, e.g. after a network change
+    if host is None:
+        _sessions.clear()
+    else:
+        _sessions.pop(host, None)
+
+
+def stats():
+    result = dict(_stats)
+    result["sessions_supported"] = sessions_supported
+    full_avg = _stats["full_ms"] / _stats["full"] if _stats["full"] else 0
+    resumed_avg = _stats["resumed_ms"] / _stats["resumed"] if _stats["resumed"] else 0
+    result["full_avg_ms"] = full_avg
+    result["resumed_avg_ms"] = resumed_avg
+    result["saved_ms"] = max(full_avg - resumed_avg, 0) * _stats["resumed"]
+    return result
@@ -0,0 +1,86 @@
+"""
+litestream
+Copyright (C) 2026  spertilo.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Checks for show_index. Run with pytest, or on the device with
+#   import test_show_index; test_show_index.run()
+
+from show_index import ShowIndex
+
+COLL_DICT = {
+    "GratefulDead": {"1970-01-01": "a", "1970-02-14": "b", "1971-01-01": "c"},
+    "Phish": {"1970-02-14": "d", "1999-12-31": "e"},
+    "TedeschiTrucksBand": {"1970-01-01": "f", "1999-12-31": "g"},
+}
+
+# Every show, in the order next_show steps through them
+SHOWS = [
+    ("1970-01-01", "GratefulDead"),
+    ("1970-01-01", "TedeschiTrucksBand"),
+    ("1970-02-14", "GratefulDead"),
+    ("1970-02-14", "Phish"),
+    ("1971-01-01", "GratefulDead"),
+    ("1999-12-31", "Phish"),
+    ("1999-12-31", "TedeschiTrucksBand"),
+]
+
+
+def test_contains():
+    index = ShowIndex(COLL_DICT)
+    assert len(index) == 4
+    assert "1970-02-14" in index
+    assert "1970-02-15" not in index
+
+
+def test_next_show_wraps():
+    index = ShowIndex(COLL_DICT)
+    for i, (date, coll) in enumerate(SHOWS):
+        assert index.next_show(date, coll) == SHOWS[(i + 1) % len(SHOWS)]
+
+
+def test_prev_show_wraps():
+    index = ShowIndex(COLL_DICT)
+    for i, (date, coll) in enumerate(SHOWS):
+        assert index.prev_show(date, coll) == SHOWS[i - 1]
+
+
+def test_round_trip():
+    index = ShowIndex(COLL_DICT)
+    for date, coll in SHOWS:
+        assert index.prev_show(*index.next_show(date, coll)) == (date, coll)
+        assert index.next_show(*index.prev_show(date, coll)) == (date, coll)
+
+
+def test_between_dates():
+    # From a date without a show, next goes to the first show after it and prev to the last show before it
+    index = ShowIndex(COLL_DICT)
+    assert index.next_show("1980-06-01", "Phish") == ("1999-12-31", "Phish")
+    assert index.prev_show("1980-06-01", "Phish") == ("1971-01-01", "GratefulDead")
+    assert index.next_show("2000-01-01", "Phish") == ("1970-01-01", "GratefulDead")
+    assert index.prev_show("1960-01-01", "Phish") == ("1999-12-31", "TedeschiTrucksBand")
+
+
+def test_empty():
+    index = ShowIndex({})
+    assert index.next_show("1970-01-01", "Phish") == ("1970-01-01", "Phish")
+    assert index.prev_show("1970-01-01", "Phish") == ("1970-01-01", "Phish")
+
+
+def run():
+    for test in (test_contains, test_next_show_wraps, test_prev_show_wraps, test_round_trip, test_between_dates, test_empty):
+        test()
+        print(f"{test.__name__} passed")
@@ -33,6 +33,7 @@ import fonts.NotoSans_bold_18 as pfont_small
 WIFI_CRED_HIST_PATH = "/config/wifi_cred_hist.json"
 WIFI_CRED_PATH = "/wifi_cred.json"
 STATE_PATH = "/config/latest_state{app_string}.json"
+POSITION_PATH = "/config/position{app_string}.json"
 DEV_BOX_PATH = "/config/.is_dev_box"
 MAIN_APP_PATH = "/config/.main_app"
 STOP_CHAR = "$StoP$"
@@ -1075,6 +1076,24 @@ def save_state(state, app_name="livemusic"):
     return
 
 
+def save_position(position, app_name="livemusic"):
+    # The playback position is kept out of the state file, since it is written much more often
+    position_path = POSITION_PATH.format(app_string=f"_{app_name}" if app_name != "livemusic" else "")
+    write_json(position, position_path)
+    return
+
+
+def load_position(app_name="livemusic"):
+    position_path = POSITION_PATH.format(app_string=f"_{app_name}" if app_name != "livemusic" else "")
+    if not path_exists(position_path):
+        return {}
+    try:
+        return read_json(position_path)
+    except Exception as e:
+        print(f"Failed to read position {e}")
+        return {}
+
+
 def load_livemusic_state(state_path):
     state = {}
     if path_exists(state_path):